@@ -2,92 +2,171 @@
 import os
 import sys
 sys.path.append('raspi')
-from time import sleep
-
-# import GUI libs
-import tkinter as tk
-from tkinter import filedialog
+import glob
+import argparse
+from time import time
+from concurrent.futures import ProcessPoolExecutor
 
 # import image processing libraries
 import cv2
 
 # import project libraries
-from raspi.image_info import get_image_info
-from raspi.lib.config_reader import ConfigReader
-
-
-class GUI(tk.Frame):
-    def __init__(self, master=None):
-        super().__init__(master)
-        self.master = master
-        self.pack()
-        self.create_widgets()
-        self.input_files = []
-        self.output_folder = ''
-
-    def create_widgets(self):
-        self.button_open_if = tk.Button(self, text="Select Input Files",
-                                        command=self.def_input_files)
-        self.button_open_if.grid(row=0,column=1)
-
-        self.listbox_inputfiles = tk.Listbox(self, height=10, width=100)
-        self.listbox_inputfiles.grid(row=0,column=0)
-
-        self.button_open_of = tk.Button(self, text="Select Output Directory",
-                                        command=self.def_output_folder)
-        self.button_open_of.grid(row=1,column=1)
-
-        self.listbox_outputfolder = tk.Listbox(self, height=1, width=100)
-        self.listbox_outputfolder.grid(row=1,column=0)
-
-        self.start = tk.Button(self, text="START", fg="green", height=1, width=30,
-                                        command=self.start_machine_vision)
-        self.start.grid(row=2,column=0)
-
-        self.exit = tk.Button(self, text="EXIT", fg="red", height=1, width=10,
-                              command=self.master.destroy)
-        self.exit.grid(row=2,column=1)
-
-        col_count, row_count = self.grid_size()
-
-        for col in range(col_count):
-            self.grid_columnconfigure(col, minsize=150)
-        for row in range(row_count):
-            self.grid_rowconfigure(row, minsize=30)
+from image_info import get_image_info
+from lib.config_reader import ConfigReader
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+SUMMARY_NAME = 'summary.txt'
+
+
+## Read, resize and process one image file
+def process_image(img_file, index, frame_width, image_parameters, output_folder):
+    image = cv2.imread(img_file)
+    if image is None:
+        print("Image " + img_file + " could not be read.")
+        return img_file, None
+
+    # Resize the image to config-defined size
+    ratio = frame_width / image.shape[1]
+    image = cv2.resize(image, (frame_width , int(image.shape[0]*ratio)))
+
+    # Read and save all the image infos, the index keeps the folder names unique
+    folder_name = "%05d_%s" % (index, os.path.splitext(os.path.basename(img_file))[0])
+    info_list = get_image_info(image, image_parameters, debug_folder_path=output_folder,
+                               max_saves=9999, folder_name=folder_name)
+    return img_file, info_list
+
+
+## Collect all image files from directories and glob patterns
+def collect_input_files(inputs):
+    files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            candidates = [os.path.join(entry, x) for x in os.listdir(entry)]
+        else:
+            candidates = glob.glob(entry)
+        files += sorted(x for x in candidates if x.lower().endswith(IMG_EXTENSIONS))
+    return files
+
+
+## Process all images on a process pool without GUI and write one summary file
+def run_batch(inputs, output_folder, workers=None):
+    input_files = collect_input_files(inputs)
+    if len(input_files) == 0:
+        print("No input images found.")
+        return []
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Read the config file once, the workers only get the plain parameters
+    config = ConfigReader()
+    w = int(config.param['camera_parameters']['frame_width'])
+    image_parameters = config.image_parameters
+
+    print("Processing " + str(len(input_files)) + " images...")
+    start = time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_image, img_file, index, w, image_parameters, output_folder)
+                   for index, img_file in enumerate(input_files)]
+        results = []
+        errors = 0
+        # A broken image must not stop the batch, its error goes into the summary
+        for img_file, f in zip(input_files, futures):
+            try:
+                results.append(f.result())
+            except Exception as e:
+                print("Image " + img_file + " could not be processed: " + str(e))
+                results.append((img_file, "ERROR: " + str(e)))
+                errors += 1
+    duration = time() - start
+
+    # One line per image: file name and info list (or the error)
+    with open(os.path.join(output_folder, SUMMARY_NAME), 'w') as txt:
+        for img_file, info_list in results:
+            txt.write(img_file + '\t' + str(info_list) + '\n')
+
+    print("Done: %d images (%d errors) in %.1f s (%.2f images/s)" % (len(results), errors, duration, len(results) / duration))
+    return results
+
+
+## Start the GUI, Tk is only imported here so the batch mode runs without it
+def run_gui():
+    # import GUI libs
+    import tkinter as tk
+    from tkinter import filedialog
+
+    class GUI(tk.Frame):
+        def __init__(self, master=None):
+            super().__init__(master)
+            self.master = master
+            self.pack()
+            self.create_widgets()
+            self.input_files = []
+            self.output_folder = ''
+
+        def create_widgets(self):
+            self.button_open_if = tk.Button(self, text="Select Input Files",
+                                            command=self.def_input_files)
+            self.button_open_if.grid(row=0,column=1)
+
+            self.listbox_inputfiles = tk.Listbox(self, height=10, width=100)
+            self.listbox_inputfiles.grid(row=0,column=0)
+
+            self.button_open_of = tk.Button(self, text="Select Output Directory",
+                                            command=self.def_output_folder)
+            self.button_open_of.grid(row=1,column=1)
+
+            self.listbox_outputfolder = tk.Listbox(self, height=1, width=100)
+            self.listbox_outputfolder.grid(row=1,column=0)
+
+            self.start = tk.Button(self, text="START", fg="green", height=1, width=30,
+                                            command=self.start_machine_vision)
+            self.start.grid(row=2,column=0)
+
+            self.exit = tk.Button(self, text="EXIT", fg="red", height=1, width=10,
+                                  command=self.master.destroy)
+            self.exit.grid(row=2,column=1)
+
+            col_count, row_count = self.grid_size()
+
+            for col in range(col_count):
+                self.grid_columnconfigure(col, minsize=150)
+            for row in range(row_count):
+                self.grid_rowconfigure(row, minsize=30)
+
+        def def_input_files(self):
+            self.input_files = list(filedialog.askopenfilenames(title="Select Input Images", filetypes = [("image",('.png', '.jpg', '.jpeg', '.gif', '.bmp'))]))
+            self.listbox_inputfiles.delete(0, tk.END)
+            self.listbox_inputfiles.insert(tk.END, *self.input_files)
+
+        def def_output_folder(self):
+            self.output_folder = filedialog.askdirectory(title="Select Output Directory")
+            self.listbox_outputfolder.delete(0, tk.END)
+            self.listbox_outputfolder.insert(tk.END, self.output_folder)
+
+        def start_machine_vision(self):
+            if len(self.input_files) * len(self.output_folder) > 0:
+                # Read the config file
+                config = ConfigReader()
+                w = int(config.param['camera_parameters']['frame_width'])
+                image_parameters = config.image_parameters
+
+                # Every image gets its own folder name, so there is no need to wait between the images
+                for index, img_file in enumerate(self.input_files):
+                    process_image(img_file, index, w, image_parameters, self.output_folder)
 
-    def def_input_files(self):
-        self.input_files = list(filedialog.askopenfilenames(title="Select Input Images", filetypes = [("image",('.png', '.jpg', '.jpeg', '.gif', '.bmp'))]))
-        self.listbox_inputfiles.delete(0, tk.END)
-        self.listbox_inputfiles.insert(tk.END, *self.input_files)
-
-    def def_output_folder(self):
-        self.output_folder = filedialog.askdirectory(title="Select Output Directory")
-        self.listbox_outputfolder.delete(0, tk.END)
-        self.listbox_outputfolder.insert(tk.END, self.output_folder)
-
-    def start_machine_vision(self):
-        if len(self.input_files) * len(self.output_folder) > 0:
-            # Read the config file
-            config = ConfigReader()
-            w = int(config.param['camera_parameters']['frame_width'])
-
-            for img_file in self.input_files:
-                image = cv2.imread(img_file)
-
-                # Resize the image to config-defined size
-                ratio = w / image.shape[1]
-                image = cv2.resize(image, (w , int(image.shape[0]*ratio)))
-
-                # Read and save all the image infos
-                get_image_info(image, config.param['image_parameters'], debug_folder_path=self.output_folder, max_saves=9999)
-
-                # Sleep for a second because the images are stored with timestamp names
-                sleep(1)
-                
-
-    
-if __name__ == '__main__':
     root = tk.Tk()
     root.title("Image Processing Standalone")
     gui = GUI(master=root)
-    gui.mainloop()   
\ No newline at end of file
+    gui.mainloop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Image Processing Standalone")
+    parser.add_argument('inputs', nargs='*', help="image directories or glob patterns (starts the batch mode)")
+    parser.add_argument('-o', '--output', default='./batch_output', help="output directory for the batch mode")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    if args.inputs:
+        run_batch(args.inputs, args.output, workers=args.jobs)
+    else:
+        run_gui()
\ No newline at end of file
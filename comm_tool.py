@@ -1,225 +1,120 @@
-# import GUI libs
-import tkinter as tk
-from tkinter import filedialog
+import sys
+sys.path.append('raspi')
+import queue
+import argparse
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 # import image processing libraries
 import numpy as np
 import cv2
-from PIL import Image, ImageTk
 
 # set up serial communication
 import serial
-import struct
+from lib.protocol import FrameDecoder, frame_to_answer, parse_command, protocols
 
-# import SSH libs
-import paramiko
-from scp import SCPClient
+# sync of the debug images over SSH
+from lib.debug_sync import sync, SftpTransport, LocalTransport
 
 USER = 'pi'
 PW = '1234'
+REMOTE_DEBUG_FOLDER = '/home/pi/Projekte/SysP2020_21_Codeleser/raspi/debug'
 
 IMG_SIZE = 500
 SHAPE_SIZE = 15
 
-class GUI(tk.Frame):
-    def __init__(self, master=None):
-        super().__init__(master)
-        self.master = master
-        self.pack()
-        self.output_folder = ''
-        self.code_img = array2image(np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255)
-        self.create_widgets()
-        
-
-    def create_widgets(self):
-        self.label_befehl = tk.Label(self, text='Befehl: ')
-        self.label_befehl.grid(row=0,sticky='E')
-        self.entry_befehl = tk.Entry(self, width=20)
-        self.entry_befehl.insert(0,'ping')
-        self.entry_befehl.grid(row=0,column=1,sticky='W')
-
-        self.label_port = tk.Label(self, text='Port: ')
-        self.label_port.grid(row=0,column=3,sticky='E')
-        self.entry_port = tk.Entry(self, width=10)
-        self.entry_port.insert(0,'COMx')
-        self.entry_port.grid(row=0,column=4,sticky='W')
-
-        self.label_bdrate = tk.Label(self, text='Speed: ')
-        self.label_bdrate.grid(row=0,column=6,sticky='E')
-        self.entry_bdrate = tk.Entry(self, width=10)
-        self.entry_bdrate.insert(0,'9600')
-        self.entry_bdrate.grid(row=0,column=7,sticky='W')
-
-        self.button_senden = tk.Button(self, text="Senden",
-                                        command=self.send_command)
-        self.button_senden.grid(row=0,column=9)
-    
-        self.label_antwort = tk.Label(self, text='Antwort: ')
-        self.label_antwort.grid(row=1)
-        self.entry_antwort = tk.Entry(self, width=80)
-        self.entry_antwort.grid(row=1,column=1,columnspan=9,sticky='W')      
-        
-        self.button_generate = tk.Button(self, text="Code generieren",
-                                         command=self.generate_code)
-        self.button_generate.grid(row=2,column=3,columnspan=3)
-        self.label_image = tk.Label(self,image=self.code_img)
-        self.label_image.image = self.code_img
-        self.label_image.grid(row=3,column=0,rowspan=1,columnspan=10)
-        self.button_save = tk.Button(self, text="Code speichern",
-                                     command=self.save_code)
-        self.button_save.grid(row=4,column=3,columnspan=3)
-        
-        self.label_ip = tk.Label(self, text='IP-Adresse: ')
-        self.label_ip.grid(row=6,column=0)
-        self.entry_ip = tk.Entry(self, width=20)
-        self.entry_ip.grid(row=6,column=1)
-        self.entry_ip.insert(0, '0.0.0.0')
-
-        self.label_user = tk.Label(self, text='User: ')
-        self.label_user.grid(row=6,column=3,sticky='E')
-        self.entry_user = tk.Entry(self, width=10)
-        self.entry_user.grid(row=6,column=4,sticky='W')
-        self.entry_user.insert(0, 'pi')
-
-        self.label_pw = tk.Label(self, text='PW: ')
-        self.label_pw.grid(row=6,column=5,sticky='E')
-        self.entry_pw = tk.Entry(self, width=10)
-        self.entry_pw.grid(row=6,column=6,sticky='W')
-        self.entry_pw.insert(0, '1234')
-        self.button_get_pics = tk.Button(self, text="Debug Bilder holen",
-                                            command=self.get_pics)
-        self.button_get_pics.grid(row=6,column=7,columnspan=3, sticky='E')
-
-        self.label_error = tk.Label(self, text='Error: ')
-        self.label_error.grid(row=7)
-        self.entry_error = tk.Entry(self, width=70)
-        self.entry_error.grid(row=7,column=1,columnspan=9,sticky='W')
-
-        col_count, row_count = self.grid_size()
-        for col in range(col_count):
-            self.grid_columnconfigure(col, minsize=30)
-        for row in range(row_count):
-            self.grid_rowconfigure(row, minsize=30)
-
-
-    def send_command(self):
-        try:
-            with serial.Serial(timeout=10.0) as ser:
-                ser.port = self.entry_port.get()
-                ser.baudrate = int(self.entry_bdrate.get())
-                ser.open()
-                ser.reset_input_buffer()
-                ser.reset_output_buffer()
-                print("Serial openend")
-
-                cmd = self.entry_befehl.get()
-                print(cmd)
-                ser.write(cmd.encode())
-                ser.write(b'\r')
-
-                print("Waiting for Message...")
-                recv_data = b''
-                while True:
-                    recv_byte = ser.read(size=1)
-                    if recv_byte == b'\n': # Messsage fully recieved
-                        print("Message recieved!")
-                        if cmd != 'shoot' and cmd != 'save':
-                            self.entry_antwort.delete(0,len(self.entry_antwort.get()))
-                            self.entry_antwort.insert(0, recv_data)
-                        else:
-                            serial_answer = struct.unpack('B'*len(recv_data), recv_data)
-                            self.entry_antwort.delete(0,len(self.entry_antwort.get()))
-                            self.entry_antwort.insert(0, serial_answer)
-                        break
-                    elif not recv_byte: # ser.read timed out
-                        print("No Message recieved!")
-                        self.entry_antwort.delete(0,len(self.entry_antwort.get()))
-                        self.entry_antwort.insert(0, "Keine Antwort erhalten! Überprüfe UART-Verbindung und COM-Port! Läuft das Communication-Programm auf dem Raspi?")
-                        break
-                    recv_data += recv_byte
-           
-        except Exception as e:
-            self.entry_antwort.delete(0,len(self.entry_antwort.get()))
-            self.entry_antwort.insert(0, e)
-
-
 
-    def generate_code(self):
-        self.code_img = array2image(np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255)
+## Persistent serial connection, gets only reopened if port or speed change
+class SerialConnection:
+    def __init__(self, timeout=10.0):
+        self.ser = None
+        self.timeout = timeout
 
-        info_string = self.entry_antwort.get().replace("[","").replace("]","").replace(",","")
-        info_list = info_string.split(' ')
-        if len(info_list) < 50: 
-            print("Can't generate Code from Answer!")
-            self.label_image.configure(image=self.code_img)
-            self.label_image.image = self.code_img
+    def open(self, port, baudrate):
+        if self.ser is not None and self.ser.is_open and self.ser.port == port and self.ser.baudrate == baudrate:
             return
-        
-        # First 5 infos are for ROI
-        info_list = info_list[5:]
-        shapes_list = []
-
-        # Group 3 entries together (shape form, x, y)
-        tmp_l = []
-        for i in range(len(info_list)):
-            tmp_l.append(int(info_list[i]))
-            if (i+1) % 3 == 0:
-                shapes_list.append(tmp_l)
-                tmp_l = []
-        
-        res_img = np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255
-        for shape in shapes_list:
-            x = int(shape[1]/255*IMG_SIZE)
-            y = int(shape[2]/255*IMG_SIZE)
-
-            if shape[0] == 0:
-                res_img = draw_circle(res_img, (x,y))
-            elif shape[0] == 1:
-                res_img = draw_triangle(res_img, (x,y))
-            elif shape[0] == 2:
-                res_img = draw_rectangle(res_img, (x,y))
-            elif shape[0] == 3:
-                res_img = draw_cross(res_img, (x,y))
-
-        self.code_img = array2image(res_img)
-        self.label_image.configure(image=self.code_img)
-        self.label_image.image = self.code_img
-
-    def save_code(self):
-        files = [('Image File', '*.png')]
-        with filedialog.asksaveasfile(filetypes = files, defaultextension = files) as file:
-            output_path = file.name
-        self.code_img._PhotoImage__photo.write(output_path)
-        print("Image saved!")
-
-    def get_pics(self):
+        self.close()
+        self.ser = serial.Serial(port=port, baudrate=baudrate, timeout=self.timeout)
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+        print("Serial openend")
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    # Send a command and wait for the answer
+    # Returns the answer (None if there was none) and the round trip time in seconds
+    def request(self, cmd, protocol):
         try:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.load_system_host_keys()
-            ssh.connect(self.entry_ip.get(), username=self.entry_user.get(), password=self.entry_pw.get())
-            
-            output_folder = filedialog.askdirectory()
-            if not output_folder: pass
+            self.ser.reset_input_buffer() # leftovers of answers that timed out
+            start = perf_counter()
+            self.ser.write(cmd.encode() + b'\r')
+            if protocol == 'framed':
+                answer = self.read_frame()
+            else:
+                answer = self.read_legacy(*parse_command(cmd))
+        except serial.SerialException:
+            self.close() # open again with the next command
+            raise
+        return answer, perf_counter() - start
+
+    # Read up to the '\n', info lists are returned as list of ints
+    # The request ID gets removed, like in the framed answers
+    def read_legacy(self, request_id, cmd):
+        recv_data = self.ser.read_until(b'\n')
+        if not recv_data.endswith(b'\n'): # ser.read timed out
+            return None
+        recv_data = recv_data[:-1]
+        if cmd == 'shoot' or cmd == 'save':
+            if request_id is not None:
+                recv_data = recv_data[1:]
+            return list(recv_data)
+        text = recv_data.decode(errors='replace')
+        prefix = str(request_id) + ':'
+        if request_id is not None and text.startswith(prefix):
+            text = text[len(prefix):]
+        return text
+
+    # Read all waiting bytes until a complete frame with a valid CRC is recieved
+    # Packed frames get unpacked to the same info list as the unpacked answers
+    def read_frame(self):
+        decoder = FrameDecoder()
+        deadline = perf_counter() + self.timeout
+        while perf_counter() < deadline:
+            frames = decoder.feed(self.ser.read(max(self.ser.in_waiting, 1)))
+            if len(frames) > 0:
+                return frame_to_answer(*frames[0])
+        print(str(decoder.errors) + " broken frames")
+        return None
+
+
+## Send 'shoot' count times and collect the round trip times
+def measure_latency(connection, count, protocol, cmd='shoot'):
+    times = []
+    failures = 0
+    for _ in range(count):
+        answer, rtt = connection.request(cmd, protocol)
+        if answer is None:
+            failures += 1
+        else:
+            times.append(rtt)
+    return times, failures
+
+def format_latency(result):
+    times, failures = result
+    if len(times) == 0:
+        return "Keine Antwort erhalten! (" + str(failures) + " Fehler)"
+    ms = np.array(times) * 1000
+    return "%d Antworten, %d Fehler: min %.1f ms, mean %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms" % (
+        len(ms), failures, ms.min(), ms.mean(), np.percentile(ms, 50), np.percentile(ms, 95), ms.max())
+
+
+def format_sync(result):
+    return "%d Dateien (%.1f MB) kopiert, %d unverändert, %d inzwischen gelöscht" % (
+        result['files'], result['bytes'] / 1e6, result['skipped'], result['vanished'])
 
-            with SCPClient(ssh.get_transport()) as scp:
-                scp.get('/home/pi/Projekte/SysP2020_21_Codeleser/raspi/debug', local_path=output_folder, recursive=True)
-            print('Images copied successfully!')
-            self.entry_error.delete(0,len(self.entry_error.get()))
-            self.entry_error.insert(0, "Bilder erfolgreich kopiert nach: " + output_folder)
-
-        except Exception as e:
-            self.entry_error.delete(0,len(self.entry_error.get()))
-            self.entry_error.insert(0, e)
-        
-
-def array2image(array):
-    border_width = 20
-    border = np.zeros((array.shape[0] + border_width*2, array.shape[1] + border_width*2, array.shape[2]), np.uint8)
-    border[border_width:border_width+array.shape[0], border_width:array.shape[1]+border_width, :] = array
-    image = Image.fromarray(border)
-    image = ImageTk.PhotoImage(image)
-    return image
 
 def draw_circle(img, pos):
     cv2.circle(img, pos, SHAPE_SIZE, (0,0,0), -1)
@@ -249,8 +144,314 @@ def draw_cross(img, pos):
     cv2.drawContours(img, [cross_cnt], 0, (0,0,0), -1)
     return img
 
-if __name__ == '__main__':
+def run_gui():
+    # import GUI libs
+    import tkinter as tk
+    from tkinter import filedialog, ttk
+    from PIL import Image, ImageTk
+
+    def array2image(array):
+        border_width = 20
+        border = np.zeros((array.shape[0] + border_width*2, array.shape[1] + border_width*2, array.shape[2]), np.uint8)
+        border[border_width:border_width+array.shape[0], border_width:array.shape[1]+border_width, :] = array
+        image = Image.fromarray(border)
+        image = ImageTk.PhotoImage(image)
+        return image
+
+
+    class GUI(tk.Frame):
+        def __init__(self, master=None):
+            super().__init__(master)
+            self.master = master
+            self.pack()
+            self.output_folder = ''
+            self.code_img = array2image(np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255)
+            self.create_widgets()
+
+            # One worker thread for the serial connection, so the GUI doesn't freeze
+            self.connection = SerialConnection()
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            # The sync of the debug images gets its own worker, so the serial commands don't have to wait
+            self.sync_executor = ThreadPoolExecutor(max_workers=1)
+            self.results = queue.Queue()
+            self.sync_progress = queue.Queue()
+            self.poll_results()
+
+
+        def create_widgets(self):
+            self.label_befehl = tk.Label(self, text='Befehl: ')
+            self.label_befehl.grid(row=0,sticky='E')
+            self.entry_befehl = tk.Entry(self, width=20)
+            self.entry_befehl.insert(0,'ping')
+            self.entry_befehl.grid(row=0,column=1,sticky='W')
+
+            self.label_port = tk.Label(self, text='Port: ')
+            self.label_port.grid(row=0,column=3,sticky='E')
+            self.entry_port = tk.Entry(self, width=10)
+            self.entry_port.insert(0,'COMx')
+            self.entry_port.grid(row=0,column=4,sticky='W')
+
+            self.label_bdrate = tk.Label(self, text='Speed: ')
+            self.label_bdrate.grid(row=0,column=6,sticky='E')
+            self.entry_bdrate = tk.Entry(self, width=10)
+            self.entry_bdrate.insert(0,'9600')
+            self.entry_bdrate.grid(row=0,column=7,sticky='W')
+
+            self.button_senden = tk.Button(self, text="Senden",
+                                            command=self.send_command)
+            self.button_senden.grid(row=0,column=9)
+
+            self.label_antwort = tk.Label(self, text='Antwort: ')
+            self.label_antwort.grid(row=1)
+            self.entry_antwort = tk.Entry(self, width=80)
+            self.entry_antwort.grid(row=1,column=1,columnspan=9,sticky='W')      
+
+            self.label_protocol = tk.Label(self, text='Protokoll: ')
+            self.label_protocol.grid(row=2,column=0,sticky='E')
+            self.protocol = tk.StringVar(self, protocols[0])
+            self.protocol_before_packed = None
+            self.option_protocol = tk.OptionMenu(self, self.protocol, *protocols)
+            self.option_protocol.grid(row=2,column=1,sticky='W')
+
+            self.button_generate = tk.Button(self, text="Code generieren",
+                                             command=self.generate_code)
+            self.button_generate.grid(row=2,column=3,columnspan=3)
+            self.label_image = tk.Label(self,image=self.code_img)
+            self.label_image.image = self.code_img
+            self.label_image.grid(row=3,column=0,rowspan=1,columnspan=10)
+            self.button_save = tk.Button(self, text="Code speichern",
+                                         command=self.save_code)
+            self.button_save.grid(row=4,column=3,columnspan=3)
+
+            self.label_count = tk.Label(self, text='Anzahl: ')
+            self.label_count.grid(row=5,column=0,sticky='E')
+            self.entry_count = tk.Entry(self, width=10)
+            self.entry_count.insert(0,'100')
+            self.entry_count.grid(row=5,column=1,sticky='W')
+            self.button_latency = tk.Button(self, text="Latenz messen",
+                                            command=self.measure_latency)
+            self.button_latency.grid(row=5,column=3,columnspan=3)
+
+            self.label_ip = tk.Label(self, text='IP-Adresse: ')
+            self.label_ip.grid(row=6,column=0)
+            self.entry_ip = tk.Entry(self, width=20)
+            self.entry_ip.grid(row=6,column=1)
+            self.entry_ip.insert(0, '0.0.0.0')
+
+            self.label_user = tk.Label(self, text='User: ')
+            self.label_user.grid(row=6,column=3,sticky='E')
+            self.entry_user = tk.Entry(self, width=10)
+            self.entry_user.grid(row=6,column=4,sticky='W')
+            self.entry_user.insert(0, 'pi')
+
+            self.label_pw = tk.Label(self, text='PW: ')
+            self.label_pw.grid(row=6,column=5,sticky='E')
+            self.entry_pw = tk.Entry(self, width=10)
+            self.entry_pw.grid(row=6,column=6,sticky='W')
+            self.entry_pw.insert(0, '1234')
+            self.button_get_pics = tk.Button(self, text="Debug Bilder holen",
+                                                command=self.get_pics)
+            self.button_get_pics.grid(row=6,column=7,columnspan=3, sticky='E')
+
+            self.label_error = tk.Label(self, text='Error: ')
+            self.label_error.grid(row=7)
+            self.entry_error = tk.Entry(self, width=70)
+            self.entry_error.grid(row=7,column=1,columnspan=9,sticky='W')
+
+            self.compress = tk.BooleanVar(self, True)
+            self.check_compress = tk.Checkbutton(self, text='Komprimieren', variable=self.compress)
+            self.check_compress.grid(row=8,column=0,columnspan=2,sticky='W')
+            self.progress_sync = ttk.Progressbar(self, length=400, maximum=100)
+            self.progress_sync.grid(row=8,column=2,columnspan=8,sticky='W')
+
+            col_count, row_count = self.grid_size()
+            for col in range(col_count):
+                self.grid_columnconfigure(col, minsize=30)
+            for row in range(row_count):
+                self.grid_rowconfigure(row, minsize=30)
+
+
+        # The serial work runs on a worker thread, the results get handed to
+        # on_done on the GUI thread by poll_results()
+        def run_in_worker(self, on_done, func, *args, executor=None):
+            executor = self.executor if executor is None else executor
+            future = executor.submit(func, *args)
+            future.add_done_callback(lambda f: self.results.put((on_done, f)))
+
+        def poll_results(self):
+            while not self.results.empty():
+                on_done, future = self.results.get()
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    answer = e
+                on_done(answer)
+            # only the newest progress of the sync gets shown
+            progress = None
+            while not self.sync_progress.empty():
+                progress = self.sync_progress.get()
+            if progress is not None:
+                self.show_sync_progress(*progress)
+            self.after(50, self.poll_results)
+
+        def show_answer(self, answer):
+            self.entry_antwort.delete(0,len(self.entry_antwort.get()))
+            self.entry_antwort.insert(0, answer)
+
+        def send_command(self):
+            cmd = self.entry_befehl.get()
+            print(cmd)
+            self.run_in_worker(lambda answer: self.show_command_answer(cmd, answer), self.job_send_command,
+                               cmd, self.entry_port.get(), int(self.entry_bdrate.get()), self.protocol.get())
+
+        def show_command_answer(self, cmd, answer):
+            self.show_answer(answer)
+            # The answers after the 'ok' come in packed frames, until 'unpacked'
+            if parse_command(cmd)[1] == 'packed' and answer == 'ok' and self.protocol_before_packed is None:
+                self.protocol_before_packed = self.protocol.get()
+                self.protocol.set('framed')
+            elif parse_command(cmd)[1] == 'unpacked' and answer == 'ok' and self.protocol_before_packed is not None:
+                self.protocol.set(self.protocol_before_packed)
+                self.protocol_before_packed = None
+
+        def job_send_command(self, cmd, port, baudrate, protocol):
+            self.connection.open(port, baudrate)
+            print("Waiting for Message...")
+            answer, _ = self.connection.request(cmd, protocol)
+            if answer is None:
+                print("No Message recieved!")
+                return "Keine Antwort erhalten! Überprüfe UART-Verbindung und COM-Port! Läuft das Communication-Programm auf dem Raspi?"
+            print("Message recieved!")
+            return answer
+
+        # Fire a number of 'shoot' commands and show the round trip statistics
+        def measure_latency(self):
+            self.run_in_worker(self.show_answer, self.job_measure_latency, int(self.entry_count.get()),
+                               self.entry_port.get(), int(self.entry_bdrate.get()), self.protocol.get())
+
+        def job_measure_latency(self, count, port, baudrate, protocol):
+            self.connection.open(port, baudrate)
+            return format_latency(measure_latency(self.connection, count, protocol))
+
+
+        def generate_code(self):
+            self.code_img = array2image(np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255)
+
+            info_string = self.entry_antwort.get().replace("[","").replace("]","").replace(",","")
+            info_list = info_string.split(' ')
+            if len(info_list) < 50: 
+                print("Can't generate Code from Answer!")
+                self.label_image.configure(image=self.code_img)
+                self.label_image.image = self.code_img
+                return
+
+            # First 5 infos are for ROI
+            info_list = info_list[5:]
+            shapes_list = []
+
+            # Group 3 entries together (shape form, x, y)
+            tmp_l = []
+            for i in range(len(info_list)):
+                tmp_l.append(int(info_list[i]))
+                if (i+1) % 3 == 0:
+                    shapes_list.append(tmp_l)
+                    tmp_l = []
+
+            res_img = np.ones((IMG_SIZE,IMG_SIZE,3), np.uint8)*255
+            for shape in shapes_list:
+                x = int(shape[1]/255*IMG_SIZE)
+                y = int(shape[2]/255*IMG_SIZE)
+
+                if shape[0] == 0:
+                    res_img = draw_circle(res_img, (x,y))
+                elif shape[0] == 1:
+                    res_img = draw_triangle(res_img, (x,y))
+                elif shape[0] == 2:
+                    res_img = draw_rectangle(res_img, (x,y))
+                elif shape[0] == 3:
+                    res_img = draw_cross(res_img, (x,y))
+
+            self.code_img = array2image(res_img)
+            self.label_image.configure(image=self.code_img)
+            self.label_image.image = self.code_img
+
+        def save_code(self):
+            files = [('Image File', '*.png')]
+            with filedialog.asksaveasfile(filetypes = files, defaultextension = files) as file:
+                output_path = file.name
+            self.code_img._PhotoImage__photo.write(output_path)
+            print("Image saved!")
+
+        # Only the new and changed debug images get copied, an interrupted sync continues where it stopped
+        def get_pics(self):
+            output_folder = filedialog.askdirectory()
+            if not output_folder:
+                return
+            self.button_get_pics.configure(state='disabled')
+            self.progress_sync['value'] = 0
+            self.show_error("Vergleiche Bilder...")
+            self.run_in_worker(lambda result: self.show_sync_result(output_folder, result), self.job_get_pics,
+                               output_folder, self.entry_ip.get(), self.entry_user.get(), self.entry_pw.get(),
+                               self.compress.get(), executor=self.sync_executor)
+
+        def job_get_pics(self, output_folder, host, user, pw, compress):
+            transport = SftpTransport(host, user, pw, REMOTE_DEBUG_FOLDER, compress=compress)
+            try:
+                return sync(transport, output_folder,
+                            progress=lambda done, total, path: self.sync_progress.put((done, total, path)))
+            finally:
+                transport.close()
+
+        def show_sync_progress(self, done, total, path):
+            self.progress_sync['value'] = 100 * done / max(total, 1)
+            self.show_error("Kopiere %s (%.1f / %.1f MB)" % (path, done / 1e6, total / 1e6))
+
+        def show_sync_result(self, output_folder, result):
+            self.button_get_pics.configure(state='normal')
+            if isinstance(result, Exception):
+                self.show_error(result)
+                return
+            print('Images copied successfully!')
+            self.progress_sync['value'] = 100
+            self.show_error(format_sync(result) + " nach: " + output_folder)
+
+        def show_error(self, text):
+            self.entry_error.delete(0,len(self.entry_error.get()))
+            self.entry_error.insert(0, text)
+
     root = tk.Tk()
     root.title("Code Generator")
     gui = GUI(master=root)
-    gui.mainloop()
\ No newline at end of file
+    gui.mainloop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Code Generator")
+    parser.add_argument('--port', help="serial port, starts the scripted latency measurement")
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--protocol', default='legacy', choices=protocols)
+    parser.add_argument('--shoot', type=int, default=100, help="number of 'shoot' commands")
+    parser.add_argument('--sync', metavar='OUTPUT', help="copy the new debug images of the Raspi to OUTPUT")
+    parser.add_argument('--host', help="IP address of the Raspi for --sync")
+    parser.add_argument('--source', help="local folder instead of the Raspi for --sync (e.g. for tests)")
+    parser.add_argument('--compress', action='store_true', help="compress the SSH connection for --sync")
+    args = parser.parse_args()
+
+    if args.port:
+        connection = SerialConnection()
+        connection.open(args.port, args.baudrate)
+        print(format_latency(measure_latency(connection, args.shoot, args.protocol)))
+        connection.close()
+    elif args.sync:
+        if args.source:
+            transport = LocalTransport(args.source)
+        elif args.host:
+            transport = SftpTransport(args.host, USER, PW, REMOTE_DEBUG_FOLDER, compress=args.compress)
+        else:
+            sys.exit("ERROR: --sync needs --host or --source")
+        try:
+            print(format_sync(sync(transport, args.sync)))
+        finally:
+            transport.close()
+    else:
+        run_gui()
\ No newline at end of file
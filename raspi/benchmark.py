@@ -0,0 +1,304 @@
+# import important system libraries
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# import image processing libraries
+import cv2
+import numpy as np
+
+# import project libraries
+import lib.image_processing as img_proc
+import lib.tracing as tracing
+from lib.config_reader import ConfigReader, ENGINE_PARAMETERS
+from image_info import get_image_info, resize_original_img
+
+# Resolutions of the camera_parameters section in config.ini
+RESOLUTIONS = {
+    'full'       : (3296, 2464),
+    'binning'    : (1664, 1232),
+    'in-between' : (2496, 1856),
+}
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# Threshold engines compared with the reference engine
+THRESH_ENGINES = ENGINE_PARAMETERS['thresh_engine']
+REFERENCE_ENGINE = 'gaussian'
+
+# ROI locators compared with the reference locator
+ROI_LOCATORS = ENGINE_PARAMETERS['roi_locator']
+REFERENCE_LOCATOR = 'floodfill'
+
+# Maximum distance of a shape position (0-255) to count as the same shape
+SHAPE_TOLERANCE = 2
+
+# Spans of get_image_info, in the order they are run (grayscale only with pipeline_mode = full)
+STAGES = ['grayscale', 'resize_original_img', 'get_roi_attr', 'get_roi',
+          'get_roi_contours', 'measure_focus', 'get_shapes']
+
+
+## Measure the time of a block and add it to the list of the stage
+@contextmanager
+def stage(timings, name):
+    start = time.perf_counter()
+    yield
+    timings.setdefault(name, []).append(time.perf_counter() - start)
+
+
+## Time the stages of get_image_info with its spans (lib.tracing)
+def run_stages(images, image_parameters, repeat, debug_folder):
+    tracing.clear()
+    tracing.enable(memory=False) # only the times, the memory tracing would slow down the stages
+    try:
+        for _ in range(repeat):
+            for img in images:
+                get_image_info(img, image_parameters, save_imgs=False,
+                               debug_folder_path=debug_folder, folder_name='benchmark')
+    finally:
+        tracing.disable()
+
+    timings = {}
+    for event in tracing.events:
+        timings.setdefault(event['name'], []).append(event['dur'] / 1e6)
+    tracing.clear()
+    return timings
+
+
+## Latency statistics of a list of durations in milliseconds
+def get_stats(durations):
+    ms = np.array(durations) * 1000
+    return {
+        'count' : len(ms),
+        'mean_ms' : float(np.mean(ms)),
+        'p50_ms' : float(np.percentile(ms, 50)),
+        'p99_ms' : float(np.percentile(ms, 99)),
+    }
+
+
+## Agreement of an info list with the one of the reference engine
+# Returns the share of the shapes found with the same type at the same position (+- SHAPE_TOLERANCE)
+def decode_agreement(reference, info_list):
+    if len(reference) < 5 or len(info_list) < 5:
+        return 1.0 if reference[:3] == info_list[:3] else 0.0
+    ref_shapes = [reference[i:i+3] for i in range(5, len(reference), 3)]
+    shapes = [info_list[i:i+3] for i in range(5, len(info_list), 3)]
+    if max(len(ref_shapes), len(shapes)) == 0:
+        return 1.0
+
+    matched = 0
+    for shape_type, x, y in ref_shapes:
+        for i, (t, sx, sy) in enumerate(shapes):
+            if t == shape_type and abs(sx - x) <= SHAPE_TOLERANCE and abs(sy - y) <= SHAPE_TOLERANCE:
+                matched += 1
+                del shapes[i]
+                break
+    return matched / max(len(ref_shapes), len(shapes) + matched)
+
+
+## Run every threshold engine on the images and compare the results with the reference engine
+def compare_thresh_engines(images, image_parameters, debug_folder):
+    results = {}
+    info_lists = {}
+    for engine in THRESH_ENGINES:
+        params = image_parameters._replace(thresh_engine=engine)
+        durations = []
+        info_lists[engine] = []
+        for img in images:
+            start = time.perf_counter()
+            info_list = get_image_info(img, params, save_imgs=False,
+                                       debug_folder_path=debug_folder, folder_name='benchmark')
+            durations.append(time.perf_counter() - start)
+            info_lists[engine].append(list(info_list))
+        results[engine] = {'total' : get_stats(durations)}
+
+    reference = info_lists[REFERENCE_ENGINE]
+    for engine in THRESH_ENGINES:
+        agreements = [decode_agreement(r, i) for r, i in zip(reference, info_lists[engine])]
+        results[engine]['identical'] = sum(r == i for r, i in zip(reference, info_lists[engine])) / len(reference)
+        results[engine]['shape_agreement'] = float(np.mean(agreements))
+    return results
+
+
+## Run every ROI locator on the resized images and compare the rects with the reference locator
+def compare_roi_locators(images, image_parameters, repeat):
+    resized = [resize_original_img(img_proc.grayscale(img), image_parameters)[0] for img in images]
+    results = {}
+    rects = {}
+    for locator in ROI_LOCATORS:
+        params = image_parameters._replace(roi_locator=locator)
+        timings = {}
+        for _ in range(repeat):
+            for img in resized:
+                with stage(timings, 'get_roi_attr'):
+                    attr, _ = img_proc.get_roi_attr(img, params)
+        rects[locator] = [img_proc.get_roi_attr(img, params)[0] for img in resized]
+        results[locator] = {'get_roi_attr' : get_stats(timings['get_roi_attr'])}
+
+    reference = rects[REFERENCE_LOCATOR]
+    for locator in ROI_LOCATORS:
+        results[locator]['same_rect'] = sum(r == a for r, a in zip(reference, rects[locator])) / len(reference)
+    return results
+
+
+## Collect all image files from a directory
+def collect_images(image_dir):
+    files = [os.path.join(image_dir, x) for x in os.listdir(image_dir)]
+    return sorted(x for x in files if x.lower().endswith(IMG_EXTENSIONS))
+
+
+## Benchmark all images at one resolution (runs in its own process for a clean peak RSS)
+def benchmark_resolution(image_files, resolution, image_parameters, repeat):
+    images = [cv2.resize(cv2.imread(f), resolution) for f in image_files]
+    debug_folder = tempfile.mkdtemp()
+    timings = {}
+
+    # Warm up once, so the first call doesn't count
+    get_image_info(images[0], image_parameters, save_imgs=False,
+                   debug_folder_path=debug_folder, folder_name='benchmark')
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            with stage(timings, 'get_image_info'):
+                get_image_info(img, image_parameters, save_imgs=False,
+                               debug_folder_path=debug_folder, folder_name='benchmark')
+    duration = time.perf_counter() - start
+
+    stage_timings = run_stages(images, image_parameters, repeat, debug_folder)
+
+    # Peak of the memory allocated by one frame, after the warm up
+    # (needs tracemalloc.reset_peak() of Python 3.9, else it's left out)
+    peak_alloc = None
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.start()
+        peak_alloc = 0
+        for img in images:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            get_image_info(img, image_parameters, save_imgs=False,
+                           debug_folder_path=debug_folder, folder_name='benchmark')
+            peak_alloc = max(peak_alloc, tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+
+    totals = timings.pop('get_image_info')
+    engines = compare_thresh_engines(images, image_parameters, debug_folder)
+    locators = compare_roi_locators(images, image_parameters, repeat)
+    return {
+        'resolution' : list(resolution),
+        'images' : len(images),
+        'repeat' : repeat,
+        'stages' : {name: get_stats(stage_timings[name]) for name in STAGES if name in stage_timings},
+        'total' : get_stats(totals),
+        'images_per_sec' : len(totals) / duration,
+        'thresh_engines' : engines,
+        'roi_locators' : locators,
+        'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_alloc_kb' : peak_alloc // 1024 if peak_alloc is not None else None,
+    }
+
+
+## Run the benchmark for all resolutions
+def run_benchmark(image_dir, resolutions, repeat=3):
+    image_files = collect_images(image_dir)
+    if len(image_files) == 0:
+        sys.exit('ERROR: No images found in ' + image_dir)
+
+    config = ConfigReader()
+    image_parameters = config.image_parameters
+
+    report = {
+        'meta' : {
+            'python' : platform.python_version(),
+            'opencv' : cv2.__version__,
+            'numpy' : np.__version__,
+            'machine' : platform.machine(),
+            'image_dir' : os.path.abspath(image_dir),
+            'image_parameters' : image_parameters._asdict(),
+        },
+        'results' : {},
+    }
+
+    for name in resolutions:
+        print("Benchmarking " + name + " " + str(RESOLUTIONS[name]) + "...")
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            result = pool.submit(benchmark_resolution, image_files, RESOLUTIONS[name],
+                                 image_parameters, repeat).result()
+        report['results'][name] = result
+        print("  %.2f images/s, p50 %.1f ms, p99 %.1f ms, peak RSS %d kB, peak allocation per frame %s kB" % (
+              result['images_per_sec'], result['total']['p50_ms'], result['total']['p99_ms'],
+              result['peak_rss_kb'], result['peak_alloc_kb']))
+        for engine, e in result['thresh_engines'].items():
+            print("  thresh_engine %-10s p50 %.1f ms, %.0f%% identical, %.1f%% of the shapes agree with %s" % (engine,
+                  e['total']['p50_ms'], e['identical'] * 100, e['shape_agreement'] * 100, REFERENCE_ENGINE))
+        for locator, l in result['roi_locators'].items():
+            print("  roi_locator %-10s get_roi_attr p50 %.2f ms, %.0f%% same rect as %s" % (locator,
+                  l['get_roi_attr']['p50_ms'], l['same_rect'] * 100, REFERENCE_LOCATOR))
+
+    return report
+
+
+## Compare a report with a baseline, returns a list of the regressions
+def compare_reports(report, baseline, tolerance=0.1):
+    regressions = []
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+
+        # Latencies must not be higher than the baseline plus tolerance
+        entries = [('total', result['total'], base['total'])]
+        entries += [(s, result['stages'][s], base['stages'][s]) for s in result['stages'] if s in base['stages']]
+        for stage_name, new, old in entries:
+            for key in ['p50_ms', 'p99_ms']:
+                if new[key] > old[key] * (1 + tolerance):
+                    regressions.append("%s %s %s: %.2f ms -> %.2f ms" % (name, stage_name, key, old[key], new[key]))
+
+        # Throughput must not be lower than the baseline minus tolerance
+        if result['images_per_sec'] < base['images_per_sec'] * (1 - tolerance):
+            regressions.append("%s images/s: %.2f -> %.2f" % (name, base['images_per_sec'], result['images_per_sec']))
+
+    return regressions
+
+
+## Main method
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the decode pipeline")
+    parser.add_argument('image_dir', help="directory with the images to replay")
+    parser.add_argument('-r', '--resolutions', nargs='+', default=list(RESOLUTIONS),
+                        choices=list(RESOLUTIONS), help="resolutions to benchmark")
+    parser.add_argument('-n', '--repeat', type=int, default=3, help="number of passes over all images")
+    parser.add_argument('-o', '--output', default=None, help="write the report as JSON to this file")
+    parser.add_argument('-c', '--compare', default=None, help="baseline report to check for regressions")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.image_dir, args.resolutions, repeat=args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Report saved to " + args.output)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, tolerance=args.tolerance)
+        if regressions:
+            print("Regressions found:")
+            for r in regressions:
+                print("  " + r)
+            sys.exit(1)
+        print("No regressions found.")
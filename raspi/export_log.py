@@ -0,0 +1,63 @@
+# import important system libraries
+import os
+import sys
+import argparse
+from datetime import datetime
+
+# import project libraries
+from lib.capture_log import CaptureLogReader
+from image_info import save_img, save_info_list
+
+
+## Parse a selection of records like '0,3,5-9' into a list of indices
+def parse_selection(selection, count):
+    indices = []
+    for part in selection.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            indices += range(int(first), int(last) + 1)
+        elif part:
+            indices.append(int(part))
+    for i in indices:
+        if not 0 <= i < count:
+            raise ValueError("Record " + str(i) + " doesn't exist, the log has " + str(count) + " records")
+    return indices
+
+
+## Export records of a capture log in the layout of the debug folders
+# One folder per record with the PNG images and image_infos.txt
+def export_records(reader, output_folder, indices):
+    os.makedirs(output_folder, exist_ok=True)
+    for i in indices:
+        entry = reader[i]
+        timestamp = datetime.fromtimestamp(entry.time).strftime("%Y-%m-%d_%H-%M-%S")
+        folder_path = os.path.join(output_folder, "%06d_%s" % (i, timestamp))
+        os.makedirs(folder_path, exist_ok=True)
+        for name, img in entry.images:
+            save_img(folder_path, name, img)
+        save_info_list(folder_path, entry.info_list)
+    print("Exported " + str(len(indices)) + " records to " + output_folder)
+
+
+## Main method
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a capture log to debug folders")
+    parser.add_argument('log', help="capture log (.clog)")
+    parser.add_argument('-o', '--output', default='./raspi/debug/export', help="output directory")
+    parser.add_argument('-r', '--records', default=None, help="records to export, e.g. '0,3,5-9' (default: all)")
+    parser.add_argument('-l', '--list', action='store_true', help="only list the records")
+    args = parser.parse_args()
+
+    reader = CaptureLogReader(args.log)
+    if args.list:
+        for i in range(len(reader)):
+            entry = reader[i]
+            timestamp = datetime.fromtimestamp(entry.time).strftime("%Y-%m-%d %H:%M:%S")
+            print("%6d  %s  %s" % (i, timestamp, entry.info_list))
+    else:
+        try:
+            indices = range(len(reader)) if args.records is None else parse_selection(args.records, len(reader))
+        except ValueError as e:
+            sys.exit('ERROR: ' + str(e))
+        export_records(reader, args.output, indices)
+    reader.close()
@@ -1,10 +1,8 @@
 # import important system libraries
 import os
 import sys
-import re
 import time
-import shutil
-from datetime import datetime
+from functools import lru_cache
 
 # import image processing libraries
 import cv2
@@ -14,27 +12,58 @@ import numpy as np
 from lib.enclosings import *
 from lib.contour_features import *
 import lib.image_processing as img_proc
+from lib.image_writer import write_img
+from lib.tracing import span, traced
+from lib.config_reader import parse_image_parameters
+from lib.buffer_pool import get_pool
+from lib.retention import get_retention, file_written
+from lib.capture_log import CaptureRecord
 
 
 ## Get all infos of every contour found
-def get_image_info(img, image_parameters, save_imgs=True, debug_folder_path='./raspi/debug/', max_saves=10):
+# img can be a BGR image or already grayscale (e.g. the luma plane of a YUV capture)
+# Without save_imgs nothing gets written to the disk
+# With a capture log (lib.capture_log.CaptureLog) the images get appended to it instead of a folder
+@traced
+def get_image_info(img, image_parameters, save_imgs=True, debug_folder_path='./raspi/debug/', max_saves=10, folder_name=None, writer=None, max_bytes=None, capture_log=None):
     # All the infos get saved in one list
     info_list = []
+    image_parameters = parse_image_parameters(image_parameters)
+    # working arrays of this thread, reused from frame to frame
+    pool = get_pool()
+    two_tier = image_parameters.pipeline_mode == 'two_tier'
     
-    img_gray = img_proc.grayscale(img)
-    img_gray_resized, w_scale, h_scale = resize_original_img(img_gray, image_parameters)
+    if two_tier:
+        # only the pixels of the resized image get converted, the ROI comes later
+        with span('resize_original_img'):
+            img_gray_resized, w_scale, h_scale = resize_original_sampled(img, image_parameters, pool=pool)
+    else:
+        if img.ndim == 2:
+            img_gray = img
+        else:
+            with span('grayscale'):
+                img_gray = img_proc.grayscale(img, dst=pool.get('gray', img.shape[:2]))
+        with span('resize_original_img'):
+            img_gray_resized, w_scale, h_scale = resize_original_img(img_gray, image_parameters, pool=pool)
 
     # Search for Region of Interest
-    roi_attr, img_bin = img_proc.get_roi_attr(img_gray_resized, image_parameters)
+    with span('get_roi_attr'):
+        roi_attr, img_bin = img_proc.get_roi_attr(img_gray_resized, image_parameters, pool=pool)
 
     # save the images for debugging purposes
-    folder_path = create_img_folder(debug_folder_path, max_saves=max_saves)
+    folder_path = None
     if save_imgs:
-        save_img(folder_path, "00_img", img_gray_resized)
-        img_bin_bgr = img_proc.bgr(img_bin.copy())
+        if capture_log is not None:
+            folder_path = capture_log.new_record()
+        else:
+            with span('create_img_folder'):
+                folder_path = create_img_folder(debug_folder_path, max_saves=max_saves,
+                                                folder_name=folder_name, max_bytes=max_bytes)
+        save_img(folder_path, "00_img", img_gray_resized, writer=writer)
+        img_bin_bgr = img_proc.bgr(img_bin)
         if roi_attr is not None:
             img_proc.draw_rectangle(img_bin_bgr, roi_attr)
-        save_img(folder_path, "01_img_binarized", img_bin_bgr) 
+        save_img(folder_path, "01_img_binarized", img_bin_bgr, writer=writer) 
     
     # Check if the Region of Interest was found
     if roi_attr is not None:
@@ -49,18 +78,25 @@ def get_image_info(img, image_parameters, save_imgs=True, debug_folder_path='./r
             # Make ROI gray and search for contours
             x,y,w,h = roi_attr
             roi_attr = (x*w_scale, y*h_scale, w*w_scale, h*h_scale)
-            roi_gray = img_proc.get_roi(img_gray, roi_attr)
-            contours, roi_bin = img_proc.get_roi_contours(roi_gray, image_parameters)
+            with span('get_roi'):
+                if two_tier:
+                    roi_gray = get_roi_gray(img, roi_attr, pool)
+                else:
+                    roi_gray = img_proc.get_roi(img_gray, roi_attr)
+            with span('get_roi_contours'):
+                contours, roi_bin = img_proc.get_roi_contours(roi_gray, image_parameters, pool=pool)
 
             # Measure focus of ROI write it to info string 
-            info_list.append(int(img_proc.measure_focus(roi_gray)))
+            with span('measure_focus'):
+                info_list.append(int(img_proc.measure_focus(roi_gray, pool=pool)))
 
             # Save images for debugging purposes
             if save_imgs:
-                save_img(folder_path, "02_roi", roi_gray)
-                save_img(folder_path, "03_roi_binarized", roi_bin)
+                save_img(folder_path, "02_roi", roi_gray, writer=writer)
+                save_img(folder_path, "03_roi_binarized", roi_bin, writer=writer)
 
-            shapes = img_proc.get_shapes(contours, roi_gray)
+            with span('get_shapes'):
+                shapes = img_proc.get_shapes(contours, roi_gray)
             info_list.append(len(shapes))
             for shape in shapes:
                 info_list.append(shape[0])
@@ -69,9 +105,9 @@ def get_image_info(img, image_parameters, save_imgs=True, debug_folder_path='./r
 
             # save images and info string for debugging purposes
             if save_imgs:
-                roi_copy = img_proc.bgr(roi_gray.copy())
+                roi_copy = img_proc.bgr(roi_gray)
                 img_proc.draw_contours(roi_copy, contours)
-                save_img(folder_path, '04_contour', roi_copy)
+                save_img(folder_path, '04_contour', roi_copy, writer=writer)
                 
 
     else: # Region of Interest was not found
@@ -80,63 +116,144 @@ def get_image_info(img, image_parameters, save_imgs=True, debug_folder_path='./r
         info_list.append(4)
         print("Region of Interest not found.")
 
-    save_info_list(folder_path, info_list)
+    if save_imgs:
+        save_info_list(folder_path, info_list)
+        if capture_log is not None:
+            with span('append capture log'):
+                capture_log.append(folder_path)
     return info_list
 
 
 ## Create and return image folder and delete old ones
-def create_img_folder(root_path, max_saves=10):
+# The old folders are kept in an index (lib.retention), the root folder is only listed once.
+# max_bytes limits the size of the old folders (None: only max_saves)
+def create_img_folder(root_path, max_saves=10, folder_name=None, max_bytes=None):
     # The path has to exist
     if not os.path.exists(root_path):
         print("Images can not be saved, because " + root_path + " does not exist.")
         return None
     
-    # If there are too much folders present delete the oldest ones
-    r = re.compile('.*-.*-.*_.*-.*-') # Define the format of the folders
-    # list all folders that match this format
-    folders = [os.path.join(root_path, x) for x in os.listdir(root_path) if r.match(x) is not None]
-    while len(folders) >= max_saves:
-        # Search for the oldest folder, delete it, and update the folder list
-        oldest_folder = min(folders, key=os.path.getctime)
-        shutil.rmtree(oldest_folder)
-        folders = [os.path.join(root_path, x) for x in os.listdir(root_path) if r.match(x) is not None]
-    
-    # Make a folder with the current timestamp as the name
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    folder_path = os.path.join(root_path, timestamp)
-    os.mkdir(folder_path)
+    # A given folder name (e.g. from the batch mode) can't collide with
+    # other images processed in the same second
+    if folder_name is not None:
+        folder_path = os.path.join(root_path, folder_name)
+        os.makedirs(folder_path, exist_ok=True)
+        return folder_path
 
-    return folder_path
+    # Make a folder with a sequence number and the current timestamp as the name
+    return get_retention(root_path).new_folder(max_saves=max_saves, max_bytes=max_bytes)
 
 
 ## Save the image as a png
-def save_img(folder_path, img_name, img):
+# With a writer (lib.image_writer.ImageWriter) the image gets saved in the background
+# folder_path can also be a record of a capture log
+def save_img(folder_path, img_name, img, writer=None):
+    if isinstance(folder_path, CaptureRecord):
+        with span('save ' + img_name):
+            folder_path.add_image(img_name, img)
     # if the folder path doesn't exist, nothing gets saved
-    if folder_path is not None:
+    elif folder_path is not None:
         full_path = os.path.join(folder_path, img_name + '.png')
-        success = cv2.imwrite(full_path, img)
-        if not success:
-            print("Saving image " + full_path + " failed.")
+        with span('save ' + img_name):
+            if writer is not None:
+                # views (e.g. of the buffer pool) get overwritten by the next frame
+                if img.base is not None:
+                    img = img.copy()
+                writer.save(full_path, img)
+            else:
+                write_img(full_path, img)
 
 
 ## Save the info string
 def save_info_list(folder_path, info_list):
+    if isinstance(folder_path, CaptureRecord):
+        folder_path.info_list = info_list
     # if the folder path doesn't exist, nothing gets saved
-    if folder_path is not None:
-        with open(os.path.join(folder_path, "image_infos.txt"), 'w') as txt:
+    elif folder_path is not None:
+        full_path = os.path.join(folder_path, "image_infos.txt")
+        with open(full_path, 'w') as txt:
             txt.write(str(info_list))
+        file_written(full_path)
     else:
         print("Info String could not be saved.")
         print("Folder Path " + str(folder_path) + " does not exist.")
 
 
-def resize_original_img(img, image_parameters):
+def resize_original_img(img, image_parameters, pool=None):
+    resize_width = parse_image_parameters(image_parameters).resize_width
+    w_resize_scale, h_resize_scale = get_resize_plan(img.shape[:2], resize_width)
     h, w = img.shape[:2]
-    img_ratio = w / h
 
-    resize_width = int(image_parameters['resize_width'])
+    dst = None
+    if pool is not None:
+        dst = pool.get('resized', (h//h_resize_scale, w//w_resize_scale) + img.shape[2:])
+    img_resized = cv2.resize(img,(w//w_resize_scale,h//h_resize_scale), dst=dst)
+
+    return img_resized, w_resize_scale, h_resize_scale
+
+
+## Same image as resize_original_img(grayscale(img)), but only the rows
+## that the resizing reads get converted to grayscale
+# With an integer factor INTER_LINEAR reads one row (odd factor) or two rows
+# (even factor) per output row. Resizing only these rows with the factor that
+# is left (1 or 2) gives the same weights and the same result.
+def resize_original_sampled(img, image_parameters, pool=None):
+    resize_width = parse_image_parameters(image_parameters).resize_width
+    w_resize_scale, h_resize_scale = get_resize_plan(img.shape[:2], resize_width)
+    h, w = img.shape[:2]
+
+    rows = linear_taps(h, h_resize_scale)
+    if len(rows) == 1:
+        sampled = img[rows[0]] # view, nothing gets copied
+    else: # interleave the row pairs
+        shape = (h//h_resize_scale*2,) + img.shape[1:]
+        sampled = np.empty(shape, np.uint8) if pool is None else pool.get('sampled', shape)
+        sampled[0::2] = img[rows[0]]
+        sampled[1::2] = img[rows[1]]
+    if sampled.ndim == 3:
+        dst = None if pool is None else pool.get('sampled_gray', sampled.shape[:2])
+        sampled = img_proc.grayscale(sampled, dst=dst)
+
+    dst = None
+    if pool is not None:
+        dst = pool.get('resized', (h//h_resize_scale, w//w_resize_scale))
+    img_resized = cv2.resize(sampled,(w//w_resize_scale,h//h_resize_scale), dst=dst)
+
+    return img_resized, w_resize_scale, h_resize_scale
+
+
+## Rows that INTER_LINEAR reads when it shrinks size by an integer scale
+# One slice if the sampling point lies on a row (odd scale), else two slices
+# for the rows on both sides of it
+def linear_taps(size, scale):
+    n = size // scale
+    first = scale//2 if scale % 2 == 1 else scale//2 - 1
+    taps = [slice(first, first + n*scale, scale)]
+    if scale % 2 == 0:
+        taps.append(slice(first + 1, first + 1 + n*scale, scale))
+    return taps
+
+
+## Cut the ROI out of the full frame and convert only this part to grayscale
+def get_roi_gray(img, roi_attr, pool=None):
+    roi = img_proc.get_roi(img, roi_attr)
+    if roi.ndim == 2:
+        return roi
+    dst = None if pool is None else pool.get('roi_gray', roi.shape[:2])
+    return img_proc.grayscale(roi, dst=dst)
+
+
+## Find the integer downscaling factors for an image size
+# The image size never changes in production, so they get computed only once
+@lru_cache(maxsize=16)
+def get_resize_plan(shape, resize_width):
+    h, w = shape
+    img_ratio = w / h
     resize_height = resize_width / img_ratio
 
+    w_resize_scale = None
+    h_resize_scale = None
+
     for i in range(2,20):
         if w % i == 0:
             if w/i <= resize_width:
@@ -148,29 +265,29 @@ def resize_original_img(img, image_parameters):
             if h/i <= resize_height:
                 h_resize_scale = i
                 break
-    
-    img_resized = cv2.resize(img,(w//w_resize_scale,h//h_resize_scale))
 
-    return img_resized, w_resize_scale, h_resize_scale
+    if w_resize_scale is None or h_resize_scale is None:
+        raise ValueError("No resize factor found for the image size " + str(w) + "x" + str(h))
+
+    return w_resize_scale, h_resize_scale
 
 
 ## Main method
 if __name__ == "__main__":
-    from picamera.array import PiRGBArray
-    from lib.cam import Camera
+    from lib.cam import create_camera
     from lib.config_reader import ConfigReader
 
     # Read the config file
     config = ConfigReader()
 
     print("Starting Camera")
-    cam = Camera(config.param['camera_parameters'])
+    cam = create_camera(config.param['camera_parameters'])
     cam.open()
     image = cam.capture_image()
     print("Image captured")
 
     # Read and save all the image infos
-    get_image_info(image, config.param['image_parameters'])
+    get_image_info(image, config.image_parameters)
     print("Done")
 
     cam.close()
@@ -0,0 +1,56 @@
+import atexit
+import queue
+import threading
+
+## Handle items on a background thread, e.g. writing the debug images
+# The items are put in a bounded queue and handled one after another by a
+# worker thread with process(), which the subclasses implement.
+# If the queue is full, put() either waits until there is space again
+# (backpressure, default) or the item gets dropped (drop_when_full=True).
+class BackgroundWorker:
+    def __init__(self, max_queue=10, drop_when_full=False):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        # make sure all queued items are handled before the program ends
+        atexit.register(self.close)
+
+    def process(self, item):
+        raise NotImplementedError
+
+    # Returns False if the item was dropped because the queue was full
+    def put(self, item):
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            self.queue.put(item)
+        return True
+
+    # Wait until all queued items are handled
+    def flush(self):
+        self.queue.join()
+
+    # Handle all queued items and stop the worker thread
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.process(item)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,43 @@
+import threading
+import numpy as np
+
+## Working arrays of the pipeline that get reused from frame to frame
+# Every named buffer keeps its memory. get() returns a contiguous array of the
+# wanted shape at the start of it, so the memory only grows if a bigger array
+# is needed (e.g. a bigger ROI or a higher resolution) and then stays.
+# An array is only valid until the next get() with the same name, so a pool
+# must not be shared between threads (see get_pool()).
+class BufferPool:
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size:
+            buf = np.empty(size, np.uint8)
+            self.buffers[name] = buf
+        return buf[:size].view(dtype).reshape(shape)
+
+    def zeros(self, name, shape, dtype=np.uint8):
+        arr = self.get(name, shape, dtype)
+        arr.fill(0)
+        return arr
+
+    # Memory held by the pool in bytes
+    def nbytes(self):
+        return sum(buf.size for buf in self.buffers.values())
+
+    def clear(self):
+        self.buffers.clear()
+
+
+local = threading.local()
+
+## Pool of the current thread
+def get_pool():
+    pool = getattr(local, 'pool', None)
+    if pool is None:
+        pool = local.pool = BufferPool()
+    return pool
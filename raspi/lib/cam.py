@@ -1,8 +1,12 @@
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+import os
 import cv2
 import time
+import threading
+import numpy as np
 
+## Base class of all camera backends
+# The backends implement open, close, capture_image, capture_continous,
+# capture_sequence and truncate_output. The background grabbing works the same for all of them.
 class Camera:
     def __init__(self, camera_config, preview=False):
         if preview:
@@ -13,18 +17,93 @@ class Camera:
             h = int(camera_config['frame_height'])
         self.resolution = (w,h)
         self.framerate = int(camera_config['frame_rate'])
-        self.format = 'bgr'
+        # The preview shows colour images, the processing only needs the luma plane of 'yuv'
+        self.format = 'bgr' if preview else camera_config.get('capture_format', 'bgr')
+        if self.format not in CAPTURE_FORMATS:
+            raise ValueError("Unknown capture format: " + self.format)
 
+        # Parameters for the background grabbing
+        self.grab_buffers = int(camera_config.get('grab_buffers', '3'))
+        self.max_frame_age = float(camera_config.get('max_frame_age', '0.2'))
+        self.grabber = None
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    # Capture one image and return it as array
+    def capture_image(self):
+        raise NotImplementedError
+
+    # Iterator of frames, the image of a frame is in frame.array
+    def capture_continous(self):
+        raise NotImplementedError
+
+    # Capture into every buffer the iterator returns, until it stops
+    def capture_sequence(self, outputs):
+        raise NotImplementedError
+
+    def truncate_output(self):
+        pass
+
+    # Empty buffer for one capture in the capture format
+    def new_buffer(self):
+        w, h = self.resolution
+        if self.format == 'yuv':
+            fw, fh = yuv_padded_size(self.resolution)
+            return np.empty(fw*fh*3//2, np.uint8)
+        return np.empty((h,w,3), np.uint8)
+
+    # Image of a filled buffer: the BGR image or the luma plane of a YUV capture (no copy)
+    def buffer_image(self, buffer):
+        if self.format == 'yuv':
+            return yuv_luma(buffer, self.resolution)
+        return buffer
+
+    # Keep grabbing frames in the background, get them with get_frame()
+    def start_grabbing(self):
+        if self.grabber is None:
+            self.grabber = FrameGrabber(self, self.grab_buffers)
+            self.grabber.start()
+
+    def stop_grabbing(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
+
+    # Freshest grabbed frame and its timestamp (time.monotonic)
+    # The frame is only valid until the next call of get_frame()
+    # With capture_format = yuv the frame is the grayscale luma plane
+    def get_frame(self, max_age=None, timeout=5.0):
+        if max_age is None:
+            max_age = self.max_frame_age
+        return self.grabber.get_frame(max_age, timeout)
+
+
+## Raspberry Pi Camera (picamera)
+class RaspiCamera(Camera):
     def open(self):
+        # picamera only exists on the Raspi
+        from picamera.array import PiRGBArray
+        from picamera import PiCamera
+
         self.camera = PiCamera(resolution=self.resolution, framerate=self.framerate)
         self.rawCapture = PiRGBArray(self.camera)
+        # YUV stills get written straight into one preallocated buffer
+        self.yuv_buffer = self.new_buffer() if self.format == 'yuv' else None
         time.sleep(5)
         print("Camera opened")
-    
+
     def close(self):
+        self.stop_grabbing()
         self.camera.close()
 
     def capture_image(self):
+        if self.format == 'yuv':
+            self.camera.capture(self.yuv_buffer, format='yuv')
+            return self.buffer_image(self.yuv_buffer)
         self.truncate_output()
         self.camera.capture(self.rawCapture, format=self.format)
         return self.rawCapture.array
@@ -33,5 +112,317 @@ class Camera:
         return self.camera.capture_continuous(self.rawCapture,
                     format=self.format, use_video_port=True)
 
+    def capture_sequence(self, outputs):
+        self.camera.capture_sequence(outputs, format=self.format, use_video_port=True)
+
     def truncate_output(self):
-        self.rawCapture.truncate(0) #empty output for next Image
\ No newline at end of file
+        self.rawCapture.truncate(0) #empty output for next Image
+
+
+## Raw YUV420 (I420) frames like picamera writes them
+# The width is padded to a multiple of 32 and the height to a multiple of 16,
+# the full Y plane is followed by the U and V planes in half resolution.
+CAPTURE_FORMATS = ['bgr', 'yuv']
+
+def yuv_padded_size(resolution):
+    w, h = resolution
+    return (w + 31) // 32 * 32, (h + 15) // 16 * 16
+
+## Luma (Y) plane of a raw YUV420 buffer, as a view without copying
+def yuv_luma(buffer, resolution):
+    w, h = resolution
+    fw, fh = yuv_padded_size(resolution)
+    return buffer[:fw*fh].reshape(fh, fw)[:h,:w]
+
+## Convert a raw YUV420 buffer to a BGR image
+def yuv_to_bgr(buffer, resolution):
+    w, h = resolution
+    fw, fh = yuv_padded_size(resolution)
+    # the padded planes are in the I420 layout of a fw x fh image
+    bgr = cv2.cvtColor(buffer.reshape(fh*3//2, fw), cv2.COLOR_YUV2BGR_I420)
+    return bgr[:h,:w]
+
+## Convert a BGR image to a raw YUV420 buffer (even width and height)
+def bgr_to_yuv(img, resolution):
+    w, h = resolution
+    fw, fh = yuv_padded_size(resolution)
+    i420 = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420).reshape(-1)
+
+    buffer = np.zeros(fw*fh*3//2, np.uint8)
+    buffer[:fw*fh].reshape(fh, fw)[:h,:w] = i420[:w*h].reshape(h, w)
+    for plane in range(2): # U and V
+        start = fw*fh + plane * (fw//2)*(fh//2)
+        src = w*h + plane * (w//2)*(h//2)
+        buffer[start:start + (fw//2)*(fh//2)].reshape(fh//2, fw//2)[:h//2,:w//2] = \
+            i420[src:src + (w//2)*(h//2)].reshape(h//2, w//2)
+    return buffer
+
+
+## Grab frames into a ring of preallocated buffers on a background thread
+# One buffer holds the freshest frame, one is handed out with get_frame()
+# and the others get written by the camera.
+class FrameGrabber:
+    def __init__(self, camera, buffer_count=3):
+        self.camera = camera
+        self.buffers = [camera.new_buffer() for _ in range(max(buffer_count, 3))]
+        self.timestamps = [0.0] * len(self.buffers)
+        self.latest = None # index of the freshest frame
+        self.in_use = None # index of the frame handed out
+        self.frame_count = 0
+        self.running = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _run(self):
+        self.camera.capture_sequence(self._outputs())
+
+    # Hand out a free buffer, and publish it once the camera asks for the next one
+    def _outputs(self):
+        while self.running:
+            with self.condition:
+                index = next(i for i in range(len(self.buffers)) if i != self.latest and i != self.in_use)
+            yield self.buffers[index]
+            with self.condition:
+                self.timestamps[index] = time.monotonic()
+                self.latest = index
+                self.frame_count += 1
+                self.condition.notify_all()
+
+    # Wait until a frame not older than max_age (in seconds) is available
+    def get_frame(self, max_age, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.in_use = None # the last frame handed out is free again
+            while self.latest is None or time.monotonic() - self.timestamps[self.latest] > max_age:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    print("No frame grabbed in time.")
+                    return None, None
+                self.condition.wait(remaining)
+            self.in_use = self.latest
+            return self.camera.buffer_image(self.buffers[self.in_use]), self.timestamps[self.in_use]
+
+
+## Camera stand-in that plays back images from arrays or files
+# The continuous captures are paced at the frame rate of the config,
+# so everything can be tested at realistic speed without a Raspi camera.
+class ArrayCamera(Camera):
+    def __init__(self, camera_config, frames=(), preview=False):
+        super().__init__(camera_config, preview)
+        self.frames = frames
+
+    def open(self):
+        self.images = [self.prepare_image(f) for f in self.frames]
+        self.index = 0
+        self.next_frame_time = time.monotonic()
+        print("Camera opened")
+
+    def close(self):
+        self.stop_grabbing()
+
+    # Bring an image (array or file name) to the resolution and format of the camera
+    def prepare_image(self, img):
+        if isinstance(img, str):
+            img = cv2.imread(img)
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if (img.shape[1], img.shape[0]) != self.resolution:
+            img = cv2.resize(img, self.resolution)
+        if self.format == 'yuv':
+            img = bgr_to_yuv(img, self.resolution)
+        return img
+
+    def next_image(self):
+        img = self.images[self.index % len(self.images)]
+        self.index += 1
+        return img
+
+    # Sleep until the next frame is due
+    def wait_next_frame(self):
+        self.next_frame_time = max(self.next_frame_time + 1 / self.framerate, time.monotonic())
+        time.sleep(max(self.next_frame_time - time.monotonic(), 0))
+
+    def capture_image(self):
+        return self.buffer_image(self.next_image().copy())
+
+    def capture_continous(self):
+        while True:
+            self.wait_next_frame()
+            yield ArrayFrame(self.buffer_image(self.next_image().copy()))
+
+    def capture_sequence(self, outputs):
+        for output in outputs:
+            self.wait_next_frame()
+            np.copyto(output, self.next_image())
+
+
+# Frame of ArrayCamera.capture_continous(), like the PiRGBArray of picamera
+class ArrayFrame:
+    def __init__(self, array):
+        self.array = array
+
+
+## Replay the images of a directory or the frames of a video file
+# The images are read one after another and the source starts over at the end.
+class ReplayCamera(ArrayCamera):
+    IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+    def __init__(self, camera_config, preview=False):
+        super().__init__(camera_config, preview=preview)
+        self.source = camera_config['replay_source']
+        self.video = None # also None for a directory of images
+
+    def open(self):
+        super().open()
+        if os.path.isdir(self.source):
+            self.files = sorted(os.path.join(self.source, x) for x in os.listdir(self.source)
+                                if x.lower().endswith(self.IMG_EXTENSIONS))
+            self.video = None
+            if len(self.files) == 0:
+                raise IOError("No images found in " + self.source)
+        else:
+            self.video = cv2.VideoCapture(self.source)
+            if not self.video.isOpened():
+                raise IOError("Video " + self.source + " can not be opened")
+
+    def close(self):
+        super().close()
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+    def next_image(self):
+        if self.video is None:
+            img = cv2.imread(self.files[self.index % len(self.files)])
+        else:
+            success, img = self.video.read()
+            if not success: # end of the video, start over
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                success, img = self.video.read()
+        self.index += 1
+        return self.prepare_image(img)
+
+
+## Synthetic code frames generated in memory
+# The code frame moves a bit from frame to frame, like on the line.
+class SyntheticCamera(ArrayCamera):
+    def __init__(self, camera_config, preview=False, frame_count=10, seed=0):
+        super().__init__(camera_config, preview=preview)
+        self.frame_count = frame_count
+        self.seed = seed
+
+    def open(self):
+        rng = np.random.default_rng(self.seed)
+        self.frames = [draw_synthetic_code(self.resolution, rng, i / self.frame_count)
+                       for i in range(self.frame_count)]
+        super().open()
+
+
+## Draw a code frame with 6x8 random shapes, phase moves it on a small circle
+def draw_synthetic_code(resolution, rng, phase=0.0):
+    w, h = resolution
+    img = np.full((h, w, 3), 200, np.uint8)
+
+    # Border of the code
+    cw, ch = int(w*0.35), int(h*0.4)
+    x0 = int(w*0.3 + w*0.02*np.cos(2*np.pi*phase))
+    y0 = int(h*0.3 + h*0.02*np.sin(2*np.pi*phase))
+    cv2.rectangle(img, (x0, y0), (x0+cw, y0+ch), (20,20,20), -1)
+    b = int(cw*0.05)
+    cv2.rectangle(img, (x0+b, y0+b), (x0+cw-b, y0+ch-b), (230,230,230), -1)
+
+    # Shapes: circle, triangle, rectangle, cross
+    s = max(int(cw*0.03), 2)
+    for i in range(6):
+        for j in range(8):
+            cx = x0 + int(cw*(0.17 + j*0.095))
+            cy = y0 + int(ch*(0.2 + i*0.12))
+            shape = rng.integers(0, 4)
+            if shape == 0:
+                cv2.circle(img, (cx,cy), s, (0,0,0), -1)
+            elif shape == 1:
+                triangle = np.array([(cx,cy-s), (cx-s,cy+s), (cx+s,cy+s)])
+                cv2.drawContours(img, [triangle], 0, (0,0,0), -1)
+            elif shape == 2:
+                cv2.rectangle(img, (cx-s,cy-s), (cx+s,cy+s), (0,0,0), -1)
+            else:
+                q = max(s//3, 1)
+                cv2.rectangle(img, (cx-q,cy-s), (cx+q,cy+s), (0,0,0), -1)
+                cv2.rectangle(img, (cx-s,cy-q), (cx+s,cy+q), (0,0,0), -1)
+
+    # a bit of blur and sensor noise
+    img = cv2.GaussianBlur(img, (5,5), 0)
+    noise = rng.normal(0, 6, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+## Replay a file of raw YUV420 frames, e.g. recorded with picamera (format='yuv')
+# The frames must have frame_width x frame_height. The file is memory mapped,
+# so a capture is a view of the luma plane in the file without reading the rest.
+# The preview gets the frames as BGR images in vid_width x vid_height.
+class RawYuvCamera(ArrayCamera):
+    def __init__(self, camera_config, preview=False):
+        super().__init__(camera_config, preview=preview)
+        self.source = camera_config['replay_source']
+        self.file_resolution = (int(camera_config['frame_width']), int(camera_config['frame_height']))
+        if not preview:
+            self.format = 'yuv'
+
+    def open(self):
+        super().open()
+        fw, fh = yuv_padded_size(self.file_resolution)
+        frame_size = fw*fh*3//2
+        data = np.memmap(self.source, np.uint8, mode='r')
+        if len(data) < frame_size:
+            raise IOError("No complete YUV frame of " + str(self.file_resolution) + " in " + self.source)
+        self.images = data[:len(data) // frame_size * frame_size].reshape(-1, frame_size)
+
+    def next_image(self):
+        img = super().next_image()
+        if self.format == 'yuv':
+            return img
+        img = yuv_to_bgr(img, self.file_resolution)
+        if self.file_resolution != self.resolution:
+            img = cv2.resize(img, self.resolution)
+        return img
+
+    def capture_image(self):
+        return self.buffer_image(self.next_image())
+
+    def capture_continous(self):
+        while True:
+            self.wait_next_frame()
+            yield ArrayFrame(self.buffer_image(self.next_image()))
+
+    ## Write images as a raw YUV file for this camera
+    @staticmethod
+    def write_file(path, images, resolution):
+        with open(path, 'wb') as f:
+            for img in images:
+                if (img.shape[1], img.shape[0]) != resolution:
+                    img = cv2.resize(img, resolution)
+                f.write(bgr_to_yuv(img, resolution).tobytes())
+
+
+# Backends selectable with 'backend' in the camera_parameters of config.ini
+backends = {
+    'picamera'  : RaspiCamera,
+    'replay'    : ReplayCamera,
+    'synthetic' : SyntheticCamera,
+    'yuvfile'   : RawYuvCamera,
+}
+
+## Create the camera backend defined in the config file
+def create_camera(camera_config, preview=False):
+    backend = camera_config.get('backend', 'picamera')
+    if backend not in backends:
+        raise ValueError("Unknown camera backend: " + backend)
+    return backends[backend](camera_config, preview=preview)
@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+from datetime import datetime
+
+import numpy as np
+
+from lib.background_worker import BackgroundWorker
+from lib.retention import get_retention
+
+## Append-only capture log
+#
+# Segment files (.clog) with all captures of a session instead of a folder of
+# PNGs per capture.
+#
+# Segment: MAGIC, then the records one after another
+# Record:  RECORD_MAGIC, meta length (u32), data length (u32), meta, data
+#          meta is JSON: time, info_list and for every image name, shape,
+#          dtype, compression, offset and length of its bytes in data
+# Index:   (.cidx next to the segment) one entry per record: offset (u64)
+#          and length (u32) of the record in the segment
+# All numbers are little endian. A record is written completely before its
+# index entry, so a crash can only lose the last record. Without the index
+# the records can still be found by scanning the segment.
+# Every segment is in its own debug folder (lib.retention). A new segment is
+# started when the current one reaches segment_bytes, and the oldest segments
+# get deleted when all of them together are bigger than max_bytes.
+# The records get compressed and written on a background thread
+# (lib.background_worker), like the PNGs of lib.image_writer.
+
+MAGIC = b'CLOG\x01'
+RECORD_MAGIC = b'CREC'
+RECORD_HEADER = struct.Struct('<4sII')
+INDEX_ENTRY = struct.Struct('<QI')
+
+COMPRESSIONS = ['zlib', 'lz4', 'none']
+
+
+def compress(data, compression):
+    if compression == 'zlib':
+        return zlib.compress(data, 1) # fastest level, the images are mostly flat
+    if compression == 'lz4':
+        import lz4.frame # optional, only needed for lz4 logs
+        return lz4.frame.compress(data)
+    return data
+
+def decompress(data, compression):
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    return data
+
+
+## One capture, filled by get_image_info() and written with CaptureLog.append()
+class CaptureRecord:
+    def __init__(self, compression):
+        self.compression = compression
+        self.time = time.time()
+        self.info_list = []
+        self.images = [] # (name, shape, dtype, raw bytes)
+
+    # The image gets copied right away, so the array can be reused
+    def add_image(self, name, img):
+        self.images.append((name, list(img.shape), str(img.dtype), np.ascontiguousarray(img).tobytes()))
+
+    # Compress the images and pack the record
+    def to_bytes(self):
+        images = []
+        blobs = []
+        offset = 0
+        for name, shape, dtype, raw in self.images:
+            blob = compress(raw, self.compression)
+            images.append({
+                'name' : name,
+                'shape' : shape,
+                'dtype' : dtype,
+                'compression' : self.compression,
+                'offset' : offset,
+                'length' : len(blob),
+            })
+            blobs.append(blob)
+            offset += len(blob)
+
+        meta = json.dumps({
+            'time' : self.time,
+            'info_list' : [int(i) for i in self.info_list],
+            'images' : images,
+        }).encode()
+        return RECORD_HEADER.pack(RECORD_MAGIC, len(meta), offset) + meta + b''.join(blobs)
+
+
+## Writer of the capture log of one session
+# If the queue is full, append() waits until there is space again
+# segment_bytes and max_bytes: None for no limit
+class CaptureLog(BackgroundWorker):
+    def __init__(self, log_dir, compression='zlib', max_queue=10, segment_bytes=None, max_bytes=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression: " + compression)
+        self.compression = compression
+        self.retention = get_retention(log_dir)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.new_segment()
+        super().__init__(max_queue=max_queue)
+
+    # Close the current segment and start the next one in a new folder
+    def new_segment(self):
+        if getattr(self, 'segment', None) is not None:
+            self.segment.close()
+            self.index.close()
+        self.folder_path = self.retention.new_folder(max_saves=None, max_bytes=self.max_bytes)
+        name = datetime.now().strftime("capture_%Y-%m-%d_%H-%M-%S")
+        self.path = os.path.join(self.folder_path, name + '.clog')
+        self.segment = open(self.path, 'ab')
+        self.segment.write(MAGIC)
+        self.index = open(index_path(self.path), 'ab')
+        self.segment_count = 0
+        self.add_bytes(len(MAGIC))
+
+    # Count the written bytes for the byte budget of the debug folders
+    def add_bytes(self, nbytes):
+        self.retention.add_bytes(os.path.basename(self.folder_path), nbytes)
+
+    def new_record(self):
+        return CaptureRecord(self.compression)
+
+    def append(self, record):
+        self.put(record)
+
+    # Write all queued records and close the files
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.segment.close()
+        self.index.close()
+
+    # Runs on the worker thread
+    def process(self, record):
+        data = record.to_bytes()
+        if self.segment_bytes is not None and self.segment_count > 0 and \
+                self.segment.tell() + len(data) > self.segment_bytes:
+            self.new_segment()
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.segment.flush()
+        self.index.write(INDEX_ENTRY.pack(offset, len(data)))
+        self.index.flush()
+        self.add_bytes(len(data) + INDEX_ENTRY.size)
+        self.count += 1
+        self.segment_count += 1
+
+
+def index_path(segment_path):
+    return os.path.splitext(segment_path)[0] + '.cidx'
+
+
+## Capture read from a log, the uncompressed images are views of the segment
+class CaptureEntry:
+    def __init__(self, time, info_list, images):
+        self.time = time
+        self.info_list = info_list
+        self.images = images # list of (name, array) in the order they were saved
+
+
+## Random access to the records of a segment, the segment is memory mapped
+class CaptureLogReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not a capture log")
+        self.entries = self.read_index()
+
+    # Offsets and lengths of the complete records
+    def read_index(self):
+        entries = []
+        if os.path.exists(index_path(self.path)):
+            with open(index_path(self.path), 'rb') as f:
+                data = f.read()
+            for i in range(len(data) // INDEX_ENTRY.size):
+                offset, length = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                if offset + length <= len(self.map):
+                    entries.append((offset, length))
+            return entries
+        return self.scan()
+
+    # Find the records without the index
+    def scan(self):
+        entries = []
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(self.map):
+            magic, meta_length, data_length = RECORD_HEADER.unpack_from(self.map, offset)
+            length = RECORD_HEADER.size + meta_length + data_length
+            if magic != RECORD_MAGIC or offset + length > len(self.map):
+                break # broken or incomplete record at the end
+            entries.append((offset, length))
+            offset += length
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        offset, _ = self.entries[i]
+        _, meta_length, _ = RECORD_HEADER.unpack_from(self.map, offset)
+        meta_start = offset + RECORD_HEADER.size
+        meta = json.loads(self.map[meta_start:meta_start + meta_length])
+        data_start = meta_start + meta_length
+
+        images = []
+        for img in meta['images']:
+            start = data_start + img['offset']
+            if img['compression'] == 'none':
+                raw = memoryview(self.map)[start:start + img['length']]
+            else:
+                raw = decompress(self.map[start:start + img['length']], img['compression'])
+            array = np.frombuffer(raw, dtype=img['dtype']).reshape(img['shape'])
+            images.append((img['name'], array))
+        return CaptureEntry(meta['time'], meta['info_list'], images)
+
+    def close(self):
+        self.entries = []
+        try:
+            self.map.close()
+        except BufferError: # views of uncompressed images still exist
+            pass
+        self.file.close()
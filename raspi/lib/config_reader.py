@@ -1,23 +1,111 @@
 from configparser import ConfigParser
+from collections import namedtuple
 import os
 import sys
 
+## Typed image parameters
+# Immutable, so they can be used as key for cached values of the pipeline
+ImageParameters = namedtuple('ImageParameters', ['blur_full', 'thresh_block_full', 'thresh_const_full',
+                                                 'blur_roi', 'thresh_block_roi', 'thresh_const_roi',
+                                                 'resize_width', 'thresh_tiles', 'thresh_engine',
+                                                 'contour_engine', 'roi_locator', 'pipeline_mode'])
+
+# Integer parameters, they have to be in the config
+INT_PARAMETERS = ['blur_full', 'thresh_block_full', 'thresh_const_full',
+                  'blur_roi', 'thresh_block_roi', 'thresh_const_roi', 'resize_width']
+
+# Optional integer parameters with their default values
+OPTIONAL_INT_PARAMETERS = {
+    'thresh_tiles' : 1,
+}
+
+# Selectable engines of the pipeline: allowed values, the first one is the default
+ENGINE_PARAMETERS = {
+    'thresh_engine' : ['gaussian', 'mean', 'background'],
+    'contour_engine' : ['contours', 'components'],
+    'roi_locator' : ['floodfill', 'external', 'components'],
+    'pipeline_mode' : ['full', 'two_tier'],
+}
+
+## Parse and validate the image parameters of a config section (or dict)
+def parse_image_parameters(section):
+    if isinstance(section, ImageParameters):
+        return section
+
+    values = {}
+    for name in INT_PARAMETERS:
+        if name not in section:
+            raise ValueError("Image parameter " + name + " is missing")
+        try:
+            values[name] = int(section[name])
+        except ValueError:
+            raise ValueError("Image parameter " + name + " is not an integer: " + str(section[name]))
+    for name, default in OPTIONAL_INT_PARAMETERS.items():
+        try:
+            values[name] = int(section.get(name, default))
+        except ValueError:
+            raise ValueError("Image parameter " + name + " is not an integer: " + str(section[name]))
+
+    for name in ['thresh_block_full', 'thresh_block_roi']:
+        if not 0 <= values[name] <= 100:
+            raise ValueError("Image parameter " + name + " must be between 0 and 100 (% of the image width)")
+    for name in ['blur_full', 'blur_roi']:
+        if values[name] < 0:
+            raise ValueError("Image parameter " + name + " can't be negative")
+    if values['resize_width'] <= 0:
+        raise ValueError("Image parameter resize_width must be bigger than 0")
+    if values['thresh_tiles'] < 1:
+        raise ValueError("Image parameter thresh_tiles must be at least 1")
+
+    for name, choices in ENGINE_PARAMETERS.items():
+        values[name] = section.get(name, choices[0])
+        if values[name] not in choices:
+            raise ValueError("Image parameter " + name + " must be one of " + ", ".join(choices))
+
+    return ImageParameters(**values)
+
+
 class ConfigReader:
     def __init__(self):
         self.param = ConfigParser()
+        self.image_parameters = None
 
         if os.path.exists('config.ini'):
-            self.config_path = 'config.ini'    
+            self.config_path = 'config.ini'
         elif os.path.exists('./raspi/config.ini'):
             self.config_path = './raspi/config.ini'
         else:
             sys.exit('ERROR: No config file found!')
-        self.read_param()
+
+        try:
+            self.read_param()
+        except ValueError as e:
+            sys.exit('ERROR: ' + str(e))
 
     def read_param(self):
+        self.mtime = os.path.getmtime(self.config_path)
         self.param.read(self.config_path)
+        if self.param.has_section('image_parameters'):
+            self.image_parameters = parse_image_parameters(self.param['image_parameters'])
+
+    # Read the config file again if it was changed on disk
+    # Returns True if new parameters were read
+    def reload_if_changed(self):
+        mtime = os.path.getmtime(self.config_path)
+        if mtime == self.mtime:
+            return False
+        try:
+            self.read_param()
+        except ValueError as e:
+            # keep the old parameters until the file is fixed
+            self.mtime = mtime
+            print('Config not reloaded: ' + str(e))
+            return False
+        print('Config reloaded')
+        return True
 
     def write_param(self):
         with open(self.config_path, 'w') as f:
             self.param.write(f)
-        print('Parameters saved')
\ No newline at end of file
+        self.mtime = os.path.getmtime(self.config_path)
+        print('Parameters saved')
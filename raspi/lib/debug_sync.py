@@ -0,0 +1,170 @@
+import os
+import json
+import errno
+import stat
+import posixpath
+
+## Incremental download of the debug folder of the Raspi
+#
+# The source lists all files with size and mtime (the remote manifest). Files
+# with the same size and mtime as in the local manifest are skipped.
+# A download goes into '<file>.<size>-<mtime>.part' and gets renamed when it is
+# complete, so an interrupted download continues where it stopped as long as
+# the remote file didn't change. Capture logs only grow, so only the new bytes
+# of them get downloaded.
+# The local manifest is append-only: one JSON line per finished file.
+
+MANIFEST_NAME = '.sync_manifest.jsonl'
+APPEND_ONLY = ('.clog', '.cidx')
+CHUNK_SIZE = 256 * 1024
+
+
+## Local directory as source, stand-in for the Raspi (e.g. for tests)
+class LocalTransport:
+    def __init__(self, root):
+        self.root = root
+
+    # All files below root: relative path -> (size, mtime)
+    def manifest(self):
+        files = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                files[os.path.relpath(path, self.root).replace(os.sep, '/')] = (st.st_size, int(st.st_mtime))
+        return files
+
+    def open(self, rel_path, offset=0, size=None):
+        f = open(os.path.join(self.root, *rel_path.split('/')), 'rb')
+        f.seek(offset)
+        return f
+
+    def close(self):
+        pass
+
+
+## Debug folder of the Raspi over SFTP
+# With compress the SSH connection compresses the data on the fly
+class SftpTransport:
+    def __init__(self, host, username, password, root, compress=False):
+        import paramiko
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh.load_system_host_keys()
+        self.ssh.connect(host, username=username, password=password, compress=compress)
+        self.sftp = self.ssh.open_sftp()
+        self.root = root
+
+    def manifest(self):
+        files = {}
+        folders = ['']
+        while folders:
+            rel_dir = folders.pop()
+            for attr in self.sftp.listdir_attr(posixpath.join(self.root, rel_dir)):
+                rel_path = posixpath.join(rel_dir, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    folders.append(rel_path)
+                else:
+                    files[rel_path] = (attr.st_size, int(attr.st_mtime))
+        return files
+
+    def open(self, rel_path, offset=0, size=None):
+        f = self.sftp.open(posixpath.join(self.root, rel_path), 'rb')
+        f.seek(offset)
+        f.prefetch(size) # request the chunks in parallel instead of one after another
+        return f
+
+    def close(self):
+        self.sftp.close()
+        self.ssh.close()
+
+
+## Read the local manifest: relative path -> (size, mtime)
+def load_manifest(local_root):
+    files = {}
+    path = os.path.join(local_root, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # last line of an interrupted sync
+                    continue
+                files[entry['path']] = (entry['size'], entry['mtime'])
+    return files
+
+
+def local_path(local_root, rel_path):
+    return os.path.join(local_root, *rel_path.split('/'))
+
+def part_path(local_root, rel_path, size, mtime):
+    return local_path(local_root, rel_path) + '.%d-%d.part' % (size, mtime)
+
+
+## Where a file gets downloaded to and from which offset
+def plan_download(local_root, rel_path, size, mtime, known):
+    dest = local_path(local_root, rel_path)
+    # a grown capture log: only the new bytes
+    if rel_path.endswith(APPEND_ONLY) and known is not None and known[0] <= size and os.path.exists(dest):
+        return dest, known[0]
+    part = part_path(local_root, rel_path, size, mtime)
+    if os.path.exists(part):
+        return part, min(os.path.getsize(part), size)
+    return part, 0
+
+
+## Copy the new and changed files of the source to local_root
+# progress(done_bytes, total_bytes, rel_path) gets called after every chunk
+# Files deleted on the source during the sync (e.g. by the retention of the
+# debug folders) are left out, they are not added to the local manifest.
+# Returns the number of copied files, copied bytes, skipped and vanished files
+def sync(transport, local_root, progress=None):
+    os.makedirs(local_root, exist_ok=True)
+    known = load_manifest(local_root)
+    remote = transport.manifest()
+
+    downloads = []
+    for rel_path, (size, mtime) in sorted(remote.items()):
+        if known.get(rel_path) == (size, mtime) and os.path.exists(local_path(local_root, rel_path)):
+            continue
+        target, offset = plan_download(local_root, rel_path, size, mtime, known.get(rel_path))
+        downloads.append((rel_path, size, mtime, target, offset))
+
+    total = sum(size - offset for _, size, _, _, offset in downloads)
+    done = 0
+    copied = 0
+    vanished = 0
+    with open(os.path.join(local_root, MANIFEST_NAME), 'a') as manifest:
+        for rel_path, size, mtime, target, offset in downloads:
+            try:
+                src = transport.open(rel_path, offset, size)
+            except OSError as e: # paramiko raises IOError(ENOENT)
+                if e.errno != errno.ENOENT:
+                    raise
+                vanished += 1
+                total -= size - offset
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'ab') as dst:
+                dst.truncate(offset) # drop bytes of an interrupted append
+                with src:
+                    while offset < size:
+                        chunk = src.read(min(CHUNK_SIZE, size - offset))
+                        if not chunk:
+                            raise IOError(rel_path + " got shorter during the download")
+                        dst.write(chunk)
+                        offset += len(chunk)
+                        done += len(chunk)
+                        if progress is not None:
+                            progress(done, total, rel_path)
+
+            dest = local_path(local_root, rel_path)
+            if target != dest:
+                os.replace(target, dest)
+            os.utime(dest, (mtime, mtime))
+            manifest.write(json.dumps({'path' : rel_path, 'size' : size, 'mtime' : mtime}) + '\n')
+            manifest.flush()
+            copied += 1
+
+    return {'files' : copied, 'bytes' : total, 'skipped' : len(remote) - len(downloads), 'vanished' : vanished}
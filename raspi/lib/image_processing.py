@@ -2,15 +2,20 @@
 import cv2
 import numpy as np
 import math
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.enclosings import *
 from lib.contour_features import *
+from lib.tracing import span
+from lib.config_reader import parse_image_parameters
+from lib.buffer_pool import BufferPool
 
 #clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(4,4))
 
 # Convert image to grayscale
-def grayscale(img):
-    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def grayscale(img, dst=None):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=dst)
 
 # Convert image to BGR-Colorspace
 def bgr(img):
@@ -18,8 +23,16 @@ def bgr(img):
 
 # Scale the thresholding block with the size of the Image
 def scale_block(img, param):
-    val = int(param)
-    val_pix = int(img.shape[1] * val / 100)
+    return block_size(img.shape[1], int(param))
+
+# Scale the blurring block with the size of the Image
+def scale_blur(img, param):
+    return blur_size(img.shape[1], int(param))
+
+# The image sizes barely change, so the block sizes get computed only once per width
+@lru_cache(maxsize=64)
+def block_size(width, val):
+    val_pix = int(width * val / 100)
     if val_pix <= 1:
         return 3
     elif val_pix % 2 == 1:
@@ -27,10 +40,10 @@ def scale_block(img, param):
     else:
         return val_pix + 1
 
-# Scale the blurring block with the size of the Image
-def scale_blur(img, param):
-    val = int(param) / 10 # reduce to 10% of the image size
-    val_pix = int(img.shape[1] * val / 100)
+@lru_cache(maxsize=64)
+def blur_size(width, val):
+    val = val / 10 # reduce to 10% of the image size
+    val_pix = int(width * val / 100)
     if val_pix > 15:
         return 15
     elif val_pix % 2 == 1:
@@ -39,11 +52,21 @@ def scale_blur(img, param):
         return val_pix + 1
 
 # Find and return coordinates from Region Of Interest (ROI)
-def get_roi_attr(img_gray, image_parameters):
+# The block sizes get scaled to scale_img (default: img_gray), so a cutout of
+# a frame can be thresholded like the whole frame
+# With a pool (lib.buffer_pool.BufferPool) the working arrays get reused,
+# the returned image is then only valid until the next call.
+def get_roi_attr(img_gray, image_parameters, scale_img=None, pool=None):
+    if scale_img is None:
+        scale_img = img_gray
+    if pool is None:
+        pool = BufferPool()
+    image_parameters = parse_image_parameters(image_parameters)
+
     # Define all parameters from config file
-    BLUR_FULL = scale_blur(img_gray, image_parameters['blur_full'])
-    THRESH_BLOCK_FULL = scale_block(img_gray, image_parameters['thresh_block_full'])
-    THRESH_CONST_FULL = int(image_parameters['thresh_const_full'])
+    BLUR_FULL = blur_size(scale_img.shape[1], image_parameters.blur_full)
+    THRESH_BLOCK_FULL = block_size(scale_img.shape[1], image_parameters.thresh_block_full)
+    THRESH_CONST_FULL = image_parameters.thresh_const_full
 
     # blur the image to filter out unwanted noise
     # blur is deactivated for now (it's too computationally intensive)
@@ -51,16 +74,24 @@ def get_roi_attr(img_gray, image_parameters):
     blur = img_gray
 
     # Adaptive thresholding to get a black and white image
-    thresh = cv2.adaptiveThreshold(blur,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV,THRESH_BLOCK_FULL,THRESH_CONST_FULL)
+    h, w = img_gray.shape[:2]
+    thresh = pool.get('roi_attr_thresh', (h,w))
+    cv2.adaptiveThreshold(blur,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY_INV,THRESH_BLOCK_FULL,THRESH_CONST_FULL, dst=thresh)
+
+    # Faster locators that work on the threshold image directly
+    if image_parameters.roi_locator == 'external':
+        return locate_roi_external(thresh), thresh
+    if image_parameters.roi_locator == 'components':
+        return locate_roi_components(thresh), thresh
 
     # use floodfill to fill all the small holes and infill our border rectangles white
-    fill = thresh.copy()
-    h, w = fill.shape[:2]
-    mask = np.zeros((h+2,w+2), np.uint8)
+    fill = pool.get('roi_attr_fill', (h,w))
+    np.copyto(fill, thresh)
+    mask = pool.zeros('roi_attr_mask', (h+2,w+2))
     cv2.floodFill(fill, mask, (0,0), 255)
-    fill_inv = cv2.bitwise_not(fill)
-    img_thresh = thresh | fill_inv
+    img_thresh = cv2.bitwise_not(fill, dst=fill)
+    cv2.bitwise_or(thresh, img_thresh, dst=img_thresh)
 
     # find all contours on the full image and hopefully also the border rectangles
     cont, _ = cv2.findContours(img_thresh, 1, 2)
@@ -74,7 +105,46 @@ def get_roi_attr(img_gray, image_parameters):
     
     return attr, img_thresh
 
+## ROI locators (roi_locator in config.ini)
+# The holes filled by floodFill lie inside of outer contours, so they don't
+# change the biggest outer contour. Only black areas that are cut off from the
+# corner by the image border are handled differently.
+
+# Bounding rect of the biggest outer contour
+def locate_roi_external(thresh):
+    cont, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(cont) == 0:
+        return None
+    c = max(cont, key = cv2.contourArea)
+    return cv2.boundingRect(c)
+
+# Bounding rect of the connected component with the biggest outer contour
+# The area of a contour can't be bigger than (w-1)*(h-1) of its bounding box,
+# so the contours of the components with the biggest boxes are enough.
+def locate_roi_components(thresh):
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    if n <= 1: # only background
+        return None
+    max_area = (stats[1:,cv2.CC_STAT_WIDTH] - 1) * (stats[1:,cv2.CC_STAT_HEIGHT] - 1)
+
+    best_area, best_label = -1, None
+    for i in np.argsort(-max_area, kind='stable'):
+        if max_area[i] < best_area:
+            break
+        x, y, w, h = stats[i+1,:4]
+        # contour of the component alone, with a free border around it
+        component = np.zeros((h+2, w+2), np.uint8)
+        component[1:-1,1:-1][labels[y:y+h,x:x+w] == i+1] = 255
+        cont, _ = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        area = cv2.contourArea(cont[0])
+        # same choice as max() over findContours, which lists the last found contour first
+        if area > best_area or (area == best_area and i+1 > best_label):
+            best_area, best_label = area, i+1
+
+    return tuple(int(v) for v in stats[best_label,:4])
+
 # Get Region of Interest (ROI)
+# The ROI is a view of the image, copy it before drawing on it
 def get_roi(img, roi_attr):
     # cut the roi out of the image
     # use only 90% of the image to leave out the border
@@ -82,14 +152,20 @@ def get_roi(img, roi_attr):
     offset_ratio = 0.1
     offset_x= int(offset_ratio*w)
     offset_y= int(offset_ratio*h)
-    return img.copy()[y+offset_y:y+h-offset_y,x+offset_x:x+w-offset_x]
+    return img[y+offset_y:y+h-offset_y,x+offset_x:x+w-offset_x]
 
 # Get all contours in the Region Of Interest (ROI)
-def get_roi_contours(roi_gray, image_parameters):
+# With a pool the returned threshold image is only valid until the next call
+def get_roi_contours(roi_gray, image_parameters, pool=None):
+    image_parameters = parse_image_parameters(image_parameters)
+    if pool is None:
+        pool = BufferPool()
+    roi_thresh = pool.get('roi_thresh', roi_gray.shape[:2])
+
     # Define all parameters from config file
-    BLUR_ROI = scale_blur(roi_gray, image_parameters['blur_roi'])
-    THRESH_BLOCK_ROI = scale_block(roi_gray, image_parameters['thresh_block_roi'])
-    THRESH_CONST_ROI = int(image_parameters['thresh_const_roi'])
+    BLUR_ROI = blur_size(roi_gray.shape[1], image_parameters.blur_roi)
+    THRESH_BLOCK_ROI = block_size(roi_gray.shape[1], image_parameters.thresh_block_roi)
+    THRESH_CONST_ROI = image_parameters.thresh_const_roi
 
     # blur the image to filter out unwanted noise
     # blur is deactivated for now (it's too computationally intensive)
@@ -99,67 +175,194 @@ def get_roi_contours(roi_gray, image_parameters):
     # TEST: use adaptive histogram matching to better the contrast on the image
     #roi_clahe = clahe.apply(roi_blur)
 
-    # sharpen image
-    blur = cv2.GaussianBlur(roi_blur, (0,0), 3)
-    roi_sharpen = cv2.addWeighted(roi_blur, 1.5, blur, -0.5, 0)
-
-    # Adaptive thresholding to get a black and white image
-    roi_thresh = cv2.adaptiveThreshold(roi_sharpen,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV,THRESH_BLOCK_ROI,THRESH_CONST_ROI)
-    # find the contours on the zoom image
-    cont_roi, _ = cv2.findContours(roi_thresh, 1, 2)
+    engine = image_parameters.thresh_engine
+    if image_parameters.thresh_tiles > 1 and engine in TILED_THRESH_ENGINES:
+        # sharpen and threshold in strips on multiple cores
+        with span('sharpen_threshold_tiled'):
+            sharpen_threshold_tiled(roi_blur, THRESH_BLOCK_ROI, THRESH_CONST_ROI,
+                                    image_parameters.thresh_tiles, engine, dst=roi_thresh)
+    else:
+        # sharpen image
+        with span('sharpen'):
+            roi_sharpen = sharpen(roi_blur, pool)
 
+        # Adaptive thresholding to get a black and white image
+        with span('threshold'):
+            threshold(roi_sharpen, THRESH_BLOCK_ROI, THRESH_CONST_ROI, engine, dst=roi_thresh)
     roi_area = roi_gray.shape[0] * roi_gray.shape[1]
-    contour_threshold = 1 / 3000
+
+    # find the contours on the zoom image
+    with span('findContours'):
+        if image_parameters.contour_engine == 'components':
+            cont_roi = find_contours_components(roi_thresh, roi_area)
+        else:
+            cont_roi, _ = cv2.findContours(roi_thresh, 1, 2)
 
     # Only accept Contours that have a minimum area
     cont = []
     for c in cont_roi:
         if c.size > 4: # more than 2 points have to be found (2 coorinates per point -> 2 points * 2 coordinates = size 4)
             area_ratio = cv2.contourArea(c) / roi_area # relative area to make it independent of image size
-            if area_ratio > contour_threshold:
+            if area_ratio > CONTOUR_THRESHOLD:
                 cont.append(c)
     
     return cont, roi_thresh
 
+# Sharpen the image with an unsharp mask
+def sharpen(img, pool=None):
+    if pool is None:
+        pool = BufferPool()
+    blur = pool.get('sharpen_blur', img.shape[:2])
+    cv2.GaussianBlur(img, (0,0), SHARPEN_SIGMA, dst=blur)
+    return cv2.addWeighted(img, 1.5, blur, -0.5, 0, dst=pool.get('sharpen', img.shape[:2]))
+
+SHARPEN_SIGMA = 3
+SHARPEN_RADIUS = 4 * SHARPEN_SIGMA # the Gaussian kernel of OpenCV is never bigger
+
+## Adaptive threshold engines (thresh_engine in config.ini)
+# Black (code) pixels get 255: pixel <= local mean - const
+# gaussian:   Gaussian weighted mean, the cost grows with the block size
+# mean:       box filter mean (running sums), the cost doesn't depend on the block size
+# background: Gaussian mean of a downsampled image, upsampled again
+def threshold(img, block, const, engine='gaussian', dst=None):
+    if engine == 'mean':
+        return cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_MEAN_C,
+                cv2.THRESH_BINARY_INV,block,const, dst=dst)
+    if engine == 'background':
+        return threshold_background(img, block, const, dst=dst)
+    return cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY_INV,block,const, dst=dst)
+
+# Engines that only look at the block around a pixel and can be split in strips
+TILED_THRESH_ENGINES = ['gaussian', 'mean']
+
+# Block size of the background engine on the downsampled image
+BACKGROUND_BLOCK = 15
+
+def threshold_background(img, block, const, dst=None):
+    h, w = img.shape[:2]
+    factor = max(block // BACKGROUND_BLOCK, 1)
+    small = cv2.resize(img, (max(w // factor, 1), max(h // factor, 1)), interpolation=cv2.INTER_AREA)
+    small_block = max((block // factor) | 1, 3)
+    background = cv2.GaussianBlur(small, (small_block, small_block), 0, borderType=cv2.BORDER_REPLICATE)
+    background = cv2.resize(background, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    # same rounding as adaptiveThreshold: black if img - mean <= -const
+    diff = cv2.subtract(img, background, dtype=cv2.CV_16S)
+    return cv2.compare(diff, -const, cv2.CMP_LE, dst=dst)
+
+# Thread pool for the strips, OpenCV releases the GIL while it works
+tile_executor = None
+tile_workers = 0
+
+# Sharpen and threshold the image in horizontal strips on a thread pool
+# Every strip gets computed with a margin of the radius of both filters, so the
+# rows that are kept don't depend on the strip borders and the result is the
+# same as threshold(sharpen()) on the whole image.
+def sharpen_threshold_tiled(img, block, const, tiles, engine='gaussian', dst=None):
+    global tile_executor, tile_workers
+    if tile_workers != tiles: # new pool if the config changed
+        if tile_executor is not None:
+            tile_executor.shutdown()
+        tile_executor = ThreadPoolExecutor(max_workers=tiles)
+        tile_workers = tiles
+
+    h = img.shape[0]
+    margin = block // 2 + SHARPEN_RADIUS
+    bounds = np.linspace(0, h, tiles + 1).astype(int)
+    thresh = np.empty(img.shape[:2], np.uint8) if dst is None else dst
+
+    def run_strip(y0, y1):
+        top = max(y0 - margin, 0)
+        bottom = min(y1 + margin, h)
+        strip = threshold(sharpen(img[top:bottom]), block, const, engine)
+        thresh[y0:y1] = strip[y0-top:y1-top]
+
+    list(tile_executor.map(run_strip, bounds[:-1], bounds[1:]))
+    return thresh
+
+# Minimum area of a contour relative to the ROI area
+CONTOUR_THRESHOLD = 1 / 3000
+
+# Find the contours only of the connected components that can be big enough
+# Every contour of a component (outer border and holes) lies inside its bounding box,
+# so its area is at most (w-1)*(h-1). Smaller components can never pass the area
+# filter and get removed before findContours, the other contours stay the same.
+def find_contours_components(roi_thresh, roi_area):
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(roi_thresh, connectivity=8)
+    max_area = (stats[:,cv2.CC_STAT_WIDTH] - 1) * (stats[:,cv2.CC_STAT_HEIGHT] - 1)
+    keep = max_area / roi_area > CONTOUR_THRESHOLD
+    keep[0] = False # background
+
+    if keep[1:].all():
+        mask = roi_thresh
+    else:
+        lut = np.where(keep, 255, 0).astype(np.uint8)
+        mask = lut[labels]
+
+    cont, _ = cv2.findContours(mask, 1, 2)
+    return cont
+
+
+# Angles of the 50 points that enclosings.circle() puts on the circle periphery
+CIRCLE_COS = np.array([math.cos(a) for a in np.linspace(0.0, 2*math.pi, num=50)])
+CIRCLE_SIN = np.array([math.sin(a) for a in np.linspace(0.0, 2*math.pi, num=50)])
+
+# Area of the polygons enclosings.circle() would create for all circles at once
+def get_circle_areas(circles):
+    centers = np.array([(int(x), int(y)) for (x,y), _ in circles], dtype=np.float64).reshape(-1,2)
+    radii = np.array([int(r) for _, r in circles], dtype=np.float64).reshape(-1,1)
+
+    # same points as enclosings.circle(), one row per circle
+    px = (centers[:,0:1] + radii*CIRCLE_COS).astype('int64').astype(np.float64)
+    py = (centers[:,1:2] + radii*CIRCLE_SIN).astype('int64').astype(np.float64)
+
+    # shoelace formula
+    return np.abs(np.sum(px*np.roll(py, -1, axis=1) - np.roll(px, -1, axis=1)*py, axis=1)) / 2
+
 
 def get_shapes(contours, roi):
-    shapes = []
+    if len(contours) == 0:
+        return []
 
-    enclosing_circles = [ circle(x) for x in contours ]
-    circle_areas = [ get_area(x, roi) for x in enclosing_circles ]
-    circle_median_area = np.median(circle_areas)
+    roi_area = (roi.shape[0] * roi.shape[1])
+
+    # Gather all measurements of the contours in arrays
+    circle_areas = get_circle_areas([cv2.minEnclosingCircle(c) for c in contours]) / roi_area
+    contour_areas = np.array([cv2.contourArea(c) for c in contours]) / roi_area
+    rects = np.array([cv2.boundingRect(c) for c in contours], dtype=np.float64).reshape(-1,4)
+    rectangle_areas = rects[:,2] * rects[:,3] / roi_area
+    hull_areas = np.array([cv2.contourArea(cv2.convexHull(c)) for c in contours]) / roi_area
+    moments = [cv2.moments(c) for c in contours]
+    m00 = np.array([m['m00'] for m in moments])
+    m10 = np.array([m['m10'] for m in moments])
+    m01 = np.array([m['m01'] for m in moments])
 
     def in_range(input_value, base_value, percent):
-        return (1-percent)*base_value <= input_value <= (1+percent)*base_value
+        return ((1-percent)*base_value <= input_value) & (input_value <= (1+percent)*base_value)
 
     shape_area_range = 0.20
-    for contour, circle_area in zip(contours, circle_areas):
+    circle_median_area = np.median(circle_areas)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
         # Check if the contour is roughly the right size
-        if circle_median_area * 0.5 <= circle_area <= circle_median_area * 3:
-            # Check if the shape is a circle
-            contour_area = get_area(contour, roi)
-            if in_range(contour_area/circle_area, 1, shape_area_range):
-                shapes.append([0, get_center(contour, roi)])
-            
-            else: # not a circle
-                # Check if the shape is a rectangle
-                enclosing_rectangle = rectangle(contour)
-                rectangle_area = get_area(enclosing_rectangle, roi)
-                if in_range(contour_area/rectangle_area, 1, shape_area_range):
-                    shapes.append([2, get_center(contour, roi)])
-                
-                else: # not a rectangle
-                    # Check if the shape is a triangle
-                    enclosing_hull = hull(contour)
-                    hull_area = get_area(enclosing_hull, roi)
-                    if in_range(contour_area/hull_area, 1, shape_area_range):
-                        shapes.append([1, get_center(contour, roi)])
-                    
-                    else: # not a triangle
-                        # so it must be a cross
-                        shapes.append([3, get_center(contour, roi)])
-    
+        valid = (circle_median_area * 0.5 <= circle_areas) & (circle_areas <= circle_median_area * 3)
+        is_circle = in_range(contour_areas/circle_areas, 1, shape_area_range)
+        is_rectangle = in_range(contour_areas/rectangle_areas, 1, shape_area_range)
+        is_triangle = in_range(contour_areas/hull_areas, 1, shape_area_range)
+
+        # Circle before rectangle before triangle, everything else is a cross
+        shape_types = np.select([is_circle, is_rectangle, is_triangle], [0, 2, 1], default=3)
+
+        # Center of every contour (999 if the contour has no area)
+        no_area = m00 == 0
+        cx = np.where(no_area, 999, m10/m00/roi.shape[1]*255)
+        cy = np.where(no_area, 999, m01/m00/roi.shape[0]*255)
+
+    shapes = []
+    for i in np.flatnonzero(valid):
+        shapes.append([int(shape_types[i]), (int(cx[i]), int(cy[i]))])
+
     return shapes
 
             
@@ -174,6 +377,11 @@ def draw_rectangle(img, rec_attr):
     cv2.rectangle(img,(x,y),(x+w,y+h),(0,255,0),2)
 
 # Measure the focus from a grayscale image
-def measure_focus(roi_gray):
-    focus = cv2.Laplacian(roi_gray, cv2.CV_64F).var()
+def measure_focus(roi_gray, pool=None):
+    if pool is None:
+        pool = BufferPool()
+    laplacian = pool.get('laplacian', roi_gray.shape[:2], np.float64)
+    cv2.Laplacian(roi_gray, cv2.CV_64F, dst=laplacian)
+    _, stddev = cv2.meanStdDev(laplacian) # variance without a temporary array
+    focus = stddev[0,0] ** 2
     return focus / 1000 * 255
\ No newline at end of file
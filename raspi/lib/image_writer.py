@@ -0,0 +1,33 @@
+import cv2
+
+from lib.background_worker import BackgroundWorker
+from lib.retention import file_written
+
+## Write debug images on a background thread
+# The images are put in a bounded queue and encoded by a worker thread, so the
+# caller doesn't have to wait for the PNG compression.
+# If the queue is full, the caller either waits until there is space again
+# (backpressure, default) or the image gets dropped (drop_when_full=True).
+# The images must not be changed after they were handed to the writer.
+class ImageWriter(BackgroundWorker):
+    def save(self, full_path, img):
+        # After closing, the images get written directly
+        if self.closed:
+            write_img(full_path, img)
+            return
+
+        if not self.put((full_path, img)):
+            print("Writer queue full, image " + full_path + " dropped.")
+
+    def process(self, item):
+        write_img(*item)
+
+
+## Write an image and report if it failed
+# The size of the file gets counted in the index of its debug folder (lib.retention)
+def write_img(full_path, img):
+    success = cv2.imwrite(full_path, img)
+    if not success:
+        print("Saving image " + full_path + " failed.")
+        return
+    file_written(full_path)
@@ -0,0 +1,134 @@
+## Compact bit-packed encoding of the info list
+#
+# Header:  flags (1 byte): bits 0-3 coordinate bit depth, bit 4 shapes follow
+#          roi_x, roi_y, roi_area (1 byte each)
+# Shapes:  focus, count (1 byte each), then for every shape in reading order
+#          (top to bottom, left to right):
+#          type (2 bits), dy (Exp-Golomb), dx (zigzag + Exp-Golomb)
+#          dy/dx are the differences of the quantized coordinates to the
+#          shape before (the first shape starts at 0,0).
+# The bit stream is filled up with zeros to a whole byte.
+
+DEFAULT_BITS = 6
+HAS_SHAPES = 0x10
+
+
+class BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.count = 0
+
+    def write(self, value, bits):
+        for i in range(bits - 1, -1, -1):
+            self.acc = (self.acc << 1) | ((value >> i) & 1)
+            self.count += 1
+            if self.count == 8:
+                self.data.append(self.acc)
+                self.acc = 0
+                self.count = 0
+
+    # Exp-Golomb code of order 0 for values >= 0
+    def write_exp_golomb(self, value):
+        value += 1
+        length = value.bit_length()
+        self.write(0, length - 1)
+        self.write(value, length)
+
+    def to_bytes(self):
+        data = bytearray(self.data)
+        if self.count > 0:
+            data.append(self.acc << (8 - self.count))
+        return bytes(data)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, bits):
+        value = 0
+        for _ in range(bits):
+            if self.pos >= len(self.data) * 8:
+                raise ValueError("Packed data too short")
+            byte = self.data[self.pos // 8]
+            value = (value << 1) | ((byte >> (7 - self.pos % 8)) & 1)
+            self.pos += 1
+        return value
+
+    def read_exp_golomb(self):
+        zeros = 0
+        while self.read(1) == 0:
+            zeros += 1
+        return ((1 << zeros) | self.read(zeros)) - 1
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+## A value has to fit in one byte
+def clamp_byte(i):
+    return min(max(int(i), 0), 255)
+
+## Quantize a coordinate (0-255) to the bit depth
+def quantize(value, bits):
+    return clamp_byte(value) >> (8 - bits)
+
+## Back to 0-255, in the middle of the quantization step
+def dequantize(value, bits):
+    step = 1 << (8 - bits)
+    return min((value << (8 - bits)) + step // 2, 255)
+
+
+## Pack an info list of get_image_info()
+def pack_info_list(info_list, bits=DEFAULT_BITS):
+    if not 1 <= bits <= 8:
+        raise ValueError("Bit depth must be between 1 and 8")
+    writer = BitWriter()
+    has_shapes = len(info_list) >= 5
+    writer.write(bits | (HAS_SHAPES if has_shapes else 0), 8)
+    for value in info_list[:3]:
+        writer.write(clamp_byte(value), 8)
+
+    if has_shapes:
+        focus = info_list[3]
+        shapes = [info_list[i:i+3] for i in range(5, len(info_list), 3)][:255] # count has one byte
+        writer.write(clamp_byte(focus), 8)
+        writer.write(len(shapes), 8)
+
+        # reading order of the quantized positions
+        shapes = sorted((quantize(y, bits), quantize(x, bits), shape_type) for shape_type, x, y in shapes)
+        last_x, last_y = 0, 0
+        for y, x, shape_type in shapes:
+            writer.write(shape_type, 2)
+            writer.write_exp_golomb(y - last_y)
+            writer.write_exp_golomb(zigzag(x - last_x))
+            last_x, last_y = x, y
+
+    return writer.to_bytes()
+
+
+## Unpack to an info list like get_image_info() returns (shapes in reading order)
+def unpack_info_list(data):
+    reader = BitReader(data)
+    flags = reader.read(8)
+    bits = flags & 0x0F
+    info_list = [reader.read(8) for _ in range(3)]
+
+    if flags & HAS_SHAPES:
+        info_list.append(reader.read(8)) # focus
+        count = reader.read(8)
+        info_list.append(count)
+        x, y = 0, 0
+        for _ in range(count):
+            shape_type = reader.read(2)
+            y += reader.read_exp_golomb()
+            x += unzigzag(reader.read_exp_golomb())
+            info_list += [shape_type, dequantize(x, bits), dequantize(y, bits)]
+
+    return info_list
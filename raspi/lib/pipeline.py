@@ -0,0 +1,50 @@
+import time
+import threading
+from collections import deque
+
+## Single-slot queue between two pipeline stages, the latest item wins
+# put() never blocks: an item that wasn't taken yet gets replaced (dropped),
+# so a slow stage always works on the newest frame instead of a backlog.
+class LatestSlot:
+    def __init__(self):
+        self.item = None
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # Returns the dropped item (None if there was none), e.g. to reuse its buffers
+    def put(self, item):
+        with self.condition:
+            dropped = self.item
+            if dropped is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify_all()
+            return dropped
+
+    # Take the item, None if there was none within timeout or the slot is closed
+    def get(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None or self.closed, timeout)
+            item, self.item = self.item, None
+            return item
+
+    # Wake up all waiting get() calls
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+## Frames per second over the last ticks
+class RateMeter:
+    def __init__(self, window=30):
+        self.ticks = deque(maxlen=window)
+
+    def tick(self):
+        self.ticks.append(time.monotonic())
+
+    def rate(self):
+        if len(self.ticks) < 2 or self.ticks[-1] == self.ticks[0]:
+            return 0.0
+        return (len(self.ticks) - 1) / (self.ticks[-1] - self.ticks[0])
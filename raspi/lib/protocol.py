@@ -0,0 +1,190 @@
+import struct
+
+from lib.packing import pack_info_list, unpack_info_list, clamp_byte
+
+## Serial protocol for the answers to the PLC
+#
+# legacy: every value is one byte, the answer ends with '\n'.
+#         10 gets sent as 11, so it can't be confused with the line feed.
+#
+# framed: FLAG | VERSION TYPE LENGTH(2) PAYLOAD CRC16(2) | FLAG
+#         Everything between the flags is byte stuffed: FLAG and ESC get
+#         replaced by ESC followed by the byte XOR 0x20 (like HDLC).
+#         LENGTH is the payload length, CRC16 is CRC-16/CCITT-FALSE over
+#         VERSION, TYPE, LENGTH and PAYLOAD. Both are big endian.
+#
+# Request IDs: a command can start with an ID (0-255), e.g. '7:shoot'.
+#         The answer then carries the same ID, so several commands can be
+#         pending at once. legacy: the first value of an info list is the ID,
+#         text answers start with '7:' (don't use ID 10 here). framed: the TAGGED bit is set in the
+#         frame type and the first payload byte is the ID.
+
+PROTOCOL_VERSION = 1
+
+FLAG = 0x7E
+ESC = 0x7D
+ESC_XOR = 0x20
+
+# Frame types
+TYPE_INTS = 0x01 # info list, one byte per value
+TYPE_TEXT = 0x02 # text answer like 'pong'
+TYPE_PACKED = 0x03 # bit-packed info list, see lib.packing
+TAGGED = 0x80 # the first payload byte is the request ID
+
+LEGACY = 'legacy'
+FRAMED = 'framed'
+protocols = [LEGACY, FRAMED]
+
+
+## CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+CRC_TABLE = _crc_table()
+
+def crc16(data, crc=0xFFFF):
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
+## Encode an info list in the legacy format
+def encode_legacy_ints(int_list):
+    data = bytearray(clamp_byte(i) for i in int_list)
+    # No byte can be 10 or it would be confused with LineFeed
+    data = data.replace(b'\n', b'\x0b')
+    return bytes(data) + b'\n'
+
+def encode_legacy_text(text):
+    return text.encode() + b'\n'
+
+
+## Byte stuffing of FLAG and ESC
+def escape(data):
+    out = bytearray()
+    for b in data:
+        if b == FLAG or b == ESC:
+            out.append(ESC)
+            out.append(b ^ ESC_XOR)
+        else:
+            out.append(b)
+    return bytes(out)
+
+def unescape(data):
+    out = bytearray()
+    escaped = False
+    for b in data:
+        if escaped:
+            out.append(b ^ ESC_XOR)
+            escaped = False
+        elif b == ESC:
+            escaped = True
+        else:
+            out.append(b)
+    return bytes(out)
+
+
+## Build a complete frame, ready for one write
+def encode_frame(frame_type, payload, request_id=None):
+    if request_id is not None:
+        frame_type |= TAGGED
+        payload = bytes([request_id]) + bytes(payload)
+    body = struct.pack('>BBH', PROTOCOL_VERSION, frame_type, len(payload)) + bytes(payload)
+    body += struct.pack('>H', crc16(body))
+    return bytes([FLAG]) + escape(body) + bytes([FLAG])
+
+
+## Encode an answer in the given protocol
+def encode_ints(int_list, protocol=LEGACY, request_id=None):
+    if protocol == FRAMED:
+        return encode_frame(TYPE_INTS, bytes(clamp_byte(i) for i in int_list), request_id)
+    if request_id is not None:
+        int_list = [request_id] + list(int_list)
+    return encode_legacy_ints(int_list)
+
+# Packed answers are always framed, they can contain any byte
+def encode_packed(int_list, bits, request_id=None):
+    return encode_frame(TYPE_PACKED, pack_info_list(int_list, bits), request_id)
+
+def encode_text(text, protocol=LEGACY, request_id=None):
+    if protocol == FRAMED:
+        return encode_frame(TYPE_TEXT, text.encode(), request_id)
+    if request_id is not None:
+        text = str(request_id) + ':' + text
+    return encode_legacy_text(text)
+
+
+## Split a command into request ID (None if there is none) and command
+def parse_command(data_str):
+    request_id, sep, cmd = data_str.partition(':')
+    if sep and request_id.isdigit() and int(request_id) <= 255:
+        return int(request_id), cmd
+    return None, data_str
+
+
+class ProtocolError(Exception):
+    pass
+
+
+## Decode the unstuffed content of a frame, returns (frame_type, payload)
+def decode_frame(body):
+    if len(body) < 6:
+        raise ProtocolError("Frame too short")
+    version, frame_type, length = struct.unpack('>BBH', body[:4])
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("Unknown protocol version " + str(version))
+    if len(body) != length + 6:
+        raise ProtocolError("Wrong frame length")
+    crc, = struct.unpack('>H', body[-2:])
+    if crc != crc16(body[:-2]):
+        raise ProtocolError("CRC mismatch")
+    return frame_type, body[4:-2]
+
+
+## Collect received bytes and return the complete frames
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.in_frame = False
+        self.errors = 0
+
+    # Returns a list of (frame_type, payload), broken frames are counted in self.errors
+    def feed(self, data):
+        frames = []
+        for b in data:
+            if b == FLAG:
+                # a flag ends the current frame and can start the next one
+                if self.in_frame and len(self.buffer) > 0:
+                    try:
+                        frames.append(decode_frame(unescape(self.buffer)))
+                    except ProtocolError as e:
+                        self.errors += 1
+                        print("Broken frame: " + str(e))
+                self.buffer = bytearray()
+                self.in_frame = True
+            elif self.in_frame:
+                self.buffer.append(b)
+        return frames
+
+
+## Split the request ID off a decoded frame, returns (request_id, frame_type, payload)
+def split_request_id(frame_type, payload):
+    if frame_type & TAGGED and len(payload) > 0:
+        return payload[0], frame_type & ~TAGGED, payload[1:]
+    return None, frame_type, payload
+
+
+## Turn a decoded frame into the answer: list of ints or text
+def frame_to_answer(frame_type, payload):
+    _, frame_type, payload = split_request_id(frame_type, payload)
+    if frame_type == TYPE_INTS:
+        return list(payload)
+    if frame_type == TYPE_PACKED:
+        return unpack_info_list(payload)
+    return payload.decode(errors='replace')
@@ -0,0 +1,131 @@
+import os
+import re
+import shutil
+import threading
+from collections import deque
+from datetime import datetime
+
+# Folders of the retention manager: sequence number and timestamp
+SEQUENCE_FOLDER = re.compile(r'^(\d{6,})_')
+# Folders of older versions: only the timestamp
+TIMESTAMP_FOLDER = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+
+
+## Keep the number and the size of the debug folders in a root folder limited
+# The root folder is listed only once, after that the folders are kept in an
+# index (oldest first). New folders get a rising sequence number, so the names
+# are unique and in order even if several images are saved in one second.
+# The index keeps a running byte total: the writers report every file they
+# write into a folder with file_written() (or add_bytes()), so nothing has to
+# be rescanned. Only the folders found at the start get measured, once, when a
+# byte budget is used for the first time.
+class DebugRetention:
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.folders = deque() # [name, size in bytes or None (not measured yet)], oldest first
+        self.index = {} # name -> entry of self.folders
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        legacy = []
+        sequence = []
+        for entry in os.scandir(root_path):
+            if not entry.is_dir():
+                continue
+            match = SEQUENCE_FOLDER.match(entry.name)
+            if match is not None:
+                sequence.append((int(match.group(1)), entry.name))
+            elif TIMESTAMP_FOLDER.match(entry.name) is not None:
+                legacy.append(entry.name)
+
+        self.next_sequence = max(s for s, _ in sequence) + 1 if sequence else 0
+        for name in sorted(legacy) + [name for _, name in sorted(sequence)]:
+            self.append(name, None)
+
+    ## Create a new folder, delete the oldest ones if there are too many or they are too big
+    # max_saves includes the new folder, max_bytes is the budget of the old folders (None: no limit)
+    def new_folder(self, max_saves=10, max_bytes=None):
+        with self.lock:
+            while max_saves is not None and len(self.folders) >= max_saves:
+                self.evict_oldest()
+            if max_bytes is not None:
+                self.measure_folders()
+                while len(self.folders) > 0 and self.total_bytes > max_bytes:
+                    self.evict_oldest()
+
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            name = "%06d_%s" % (self.next_sequence, timestamp)
+            folder_path = os.path.join(self.root_path, name)
+            os.mkdir(folder_path)
+            self.next_sequence += 1
+            self.append(name, 0)
+            return folder_path
+
+    ## Count bytes written into a folder of the index
+    def add_bytes(self, name, nbytes):
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is not None and entry[1] is not None:
+                entry[1] += nbytes
+                self.total_bytes += nbytes
+
+    def append(self, name, size):
+        entry = [name, size]
+        self.folders.append(entry)
+        self.index[name] = entry
+
+    # Measure the folders of the start (they are the only ones with an unknown size)
+    def measure_folders(self):
+        for entry in self.folders:
+            if entry[1] is not None:
+                break # all later folders were created by this index
+            entry[1] = folder_size(os.path.join(self.root_path, entry[0]))
+            self.total_bytes += entry[1]
+
+    def evict_oldest(self):
+        name, size = self.folders.popleft()
+        del self.index[name]
+        if size is not None:
+            self.total_bytes -= size
+        shutil.rmtree(os.path.join(self.root_path, name), ignore_errors=True)
+
+
+## Size of all files in a folder (and its subfolders) in bytes
+def folder_size(path):
+    size = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                size += folder_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError: # deleted by someone else
+        pass
+    return size
+
+
+managers = {}
+managers_lock = threading.Lock()
+
+## Retention manager of a root folder, there is one per folder and process
+def get_retention(root_path):
+    key = os.path.abspath(root_path)
+    with managers_lock:
+        if key not in managers:
+            managers[key] = DebugRetention(root_path)
+        return managers[key]
+
+
+## Report a file written into a debug folder, its size counts for the byte budget
+# Files outside of the folders of a retention manager are ignored
+def file_written(full_path):
+    folder_path = os.path.dirname(full_path)
+    with managers_lock:
+        manager = managers.get(os.path.abspath(os.path.dirname(folder_path)))
+    if manager is None:
+        return
+    try:
+        size = os.path.getsize(full_path)
+    except OSError: # the writing failed or the folder was evicted already
+        return
+    manager.add_bytes(os.path.basename(folder_path), size)
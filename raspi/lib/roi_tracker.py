@@ -0,0 +1,76 @@
+import numpy as np
+
+import lib.image_processing as img_proc
+
+## Track the Region Of Interest (ROI) from frame to frame
+# The code frame barely moves between two frames of the preview, so the ROI
+# gets searched only in a padded window around the ROI of the last frame.
+# If the ROI is not found there with confidence, the whole frame is searched.
+class RoiTracker:
+    def __init__(self, padding=0.25, area_tolerance=0.3):
+        self.padding = padding # padding of the window relative to the ROI size
+        self.area_tolerance = area_tolerance # allowed area change between two frames
+        self.last_attr = None
+        self.frames = 0
+        self.hits = 0
+
+    # Same output as img_proc.get_roi_attr()
+    # With a pool (lib.buffer_pool.BufferPool) the binary image is reused from frame to frame
+    def get_roi_attr(self, img_gray, image_parameters, pool=None):
+        self.frames += 1
+
+        if self.last_attr is not None:
+            result = self.search_window(img_gray, image_parameters, pool)
+            if result is not None:
+                self.hits += 1
+                self.last_attr = result[0]
+                return result
+
+        # Fallback: search the whole frame
+        attr, img_bin = img_proc.get_roi_attr(img_gray, image_parameters, pool=pool)
+        self.last_attr = attr
+        return attr, img_bin
+
+    # Search the ROI around the last one, returns None if it was not found reliably
+    def search_window(self, img_gray, image_parameters, pool=None):
+        x,y,w,h = self.last_attr
+        img_h, img_w = img_gray.shape[:2]
+        pad_x = int(w * self.padding)
+        pad_y = int(h * self.padding)
+        x0, y0 = max(x - pad_x, 0), max(y - pad_y, 0)
+        x1, y1 = min(x + w + pad_x, img_w), min(y + h + pad_y, img_h)
+
+        window = img_gray[y0:y1, x0:x1]
+        attr, window_bin = img_proc.get_roi_attr(window, image_parameters, scale_img=img_gray, pool=pool)
+        if attr is None:
+            return None
+
+        # The ROI must not touch the window border (except if it's the frame border),
+        # otherwise the code frame has probably moved out of the window
+        wx, wy, ww, wh = attr
+        if (wx == 0 and x0 > 0) or (wy == 0 and y0 > 0) or \
+                (wx + ww == x1 - x0 and x1 < img_w) or (wy + wh == y1 - y0 and y1 < img_h):
+            return None
+
+        # The ROI must have roughly the same size as in the last frame
+        area = w * h
+        if not (1 - self.area_tolerance) * area <= ww * wh <= (1 + self.area_tolerance) * area:
+            return None
+
+        # Binary image in full frame size, black outside of the window
+        if pool is None:
+            img_bin = np.zeros_like(img_gray)
+        else:
+            img_bin = pool.zeros('tracker_bin', img_gray.shape)
+        img_bin[y0:y1, x0:x1] = window_bin
+
+        return (x0 + wx, y0 + wy, ww, wh), img_bin
+
+    # Ratio of the frames where the ROI was found in the window
+    def hit_rate(self):
+        if self.frames == 0:
+            return 0.0
+        return self.hits / self.frames
+
+    def reset(self):
+        self.last_attr = None
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import atexit
+import threading
+import tracemalloc
+import functools
+from contextlib import nullcontext
+
+## Optional tracing of the pipeline stages
+# Records wall time and allocated bytes of every stage and writes them as
+# Chrome trace events (open with chrome://tracing or https://ui.perfetto.dev).
+# Enable it with tracing.enable() or with the environment variable
+# CODELESER_TRACE=<path of the json file>; the trace gets saved on exit.
+# When disabled, span() only returns a shared empty context.
+# tracemalloc.reset_peak() needs Python 3.9, before that allocated_bytes
+# only counts the memory that is still allocated at the end of the stage.
+
+enabled = False
+trace_path = None
+events = []
+
+NULL_SPAN = nullcontext()
+RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+_local = threading.local()
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        self.mem_start, peak = tracemalloc.get_traced_memory()
+        # Peak of the span itself, the parent keeps the peak it has seen so far
+        if RESET_PEAK:
+            if stack:
+                stack[-1].max_seen = max(stack[-1].max_seen, peak)
+            tracemalloc.reset_peak()
+        self.max_seen = self.mem_start
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        mem_end, peak = tracemalloc.get_traced_memory()
+        stack = _stack()
+        stack.pop()
+        self.max_seen = max(self.max_seen, peak if RESET_PEAK else mem_end)
+        if stack:
+            stack[-1].max_seen = max(stack[-1].max_seen, self.max_seen)
+
+        events.append({
+            'name' : self.name,
+            'ph' : 'X',
+            'ts' : self.start * 1e6,
+            'dur' : (end - self.start) * 1e6,
+            'pid' : os.getpid(),
+            'tid' : threading.get_ident(),
+            'args' : {
+                'allocated_bytes' : self.max_seen - self.mem_start, # peak allocation during the stage
+                'retained_bytes' : mem_end - self.mem_start,
+            },
+        })
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+## Context manager for one stage, costs nearly nothing when tracing is disabled
+def span(name):
+    if not enabled:
+        return NULL_SPAN
+    return Span(name)
+
+
+## Decorator to trace a whole function
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        with Span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Without memory only the times are recorded (allocated_bytes stays 0),
+# tracemalloc slows down every allocation
+def enable(path=None, memory=True):
+    global enabled, trace_path
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    trace_path = path
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def clear():
+    del events[:]
+
+
+## Write all recorded events as Chrome trace JSON
+def save(path=None):
+    if path is None:
+        path = trace_path
+    if path is None:
+        return
+    with open(path, 'w') as f:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+    print("Trace saved to " + path)
+
+
+def _save_on_exit():
+    if enabled and events:
+        save()
+
+
+atexit.register(_save_on_exit)
+
+if os.environ.get('CODELESER_TRACE'):
+    enable(os.environ['CODELESER_TRACE'])
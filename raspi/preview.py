@@ -3,88 +3,218 @@ import os
 import sys
 import argparse
 import time
+import queue
+import threading
+import traceback
 from configparser import ConfigParser
 
 # import image processing libraries
 import cv2
-from picamera.array import PiRGBArray
 import numpy as np
 
 # import project libraries
 from lib.enclosings import *
 import lib.image_processing as img_proc
 from lib.config_reader import ConfigReader
-from lib.cam import Camera
+from lib.cam import create_camera
+from lib.roi_tracker import RoiTracker
+from lib.pipeline import LatestSlot, RateMeter
+from lib.buffer_pool import BufferPool
 
-## Get all 4 Images for the live Preview, plus the focus image
-def get_preview(img, enclosure_func, image_parameters):   
-    img_gray = img_proc.grayscale(img)
+## Preview at display resolution: 4 panels and a strip for the text below them
+# The canvas is allocated once. Every image gets resized directly into its
+# panel (a view of the canvas), so there are no full frame copies and every
+# image gets resampled only once. The drawings are scaled to the panels.
+class PreviewCanvas:
+    TEXT_HEIGHT = 40
+    FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+    def __init__(self, size):
+        w, h = size
+        self.image = np.zeros((h, w, 3), np.uint8)
+        panel_w, panel_h = w // 2, (h - self.TEXT_HEIGHT) // 2
+        # full image, binary image, ROI, binary ROI
+        self.panels = [self.image[r*panel_h:(r+1)*panel_h, c*panel_w:(c+1)*panel_w] for r in (0, 1) for c in (0, 1)]
+        self.text = self.image[2*panel_h:]
+        self.gray = np.empty((panel_h, panel_w), np.uint8) # grayscale images before the colour conversion
+
+    # Resize img into the panel, returns the x and y scale of the drawings
+    def draw_panel(self, index, img):
+        panel = self.panels[index]
+        size = (panel.shape[1], panel.shape[0])
+        if img.ndim == 2:
+            cv2.resize(img, size, dst=self.gray)
+            cv2.cvtColor(self.gray, cv2.COLOR_GRAY2BGR, dst=panel)
+        else:
+            cv2.resize(img, size, dst=panel)
+        return size[0] / img.shape[1], size[1] / img.shape[0]
+
+    def clear_panel(self, index):
+        self.panels[index].fill(0)
+
+    def draw_rectangle(self, index, rec_attr, scale):
+        x,y,w,h = rec_attr
+        sx, sy = scale
+        img_proc.draw_rectangle(self.panels[index], (int(x*sx), int(y*sy), int(w*sx), int(h*sy)))
+
+    def draw_contours(self, index, contours, scale):
+        scale = np.array(scale)
+        img_proc.draw_contours(self.panels[index], [(c * scale).astype(np.int32) for c in contours])
+
+    # The text strip has two lines
+    def write_text(self, line, text):
+        if line == 0:
+            self.text.fill(0)
+        cv2.putText(self.text, text, (10, 16 + line*18), self.FONT, 0.5, (255, 255, 255), 1)
+
+
+## Draw all 4 Images of the live Preview and the focus on a PreviewCanvas
+# With a tracker (lib.roi_tracker.RoiTracker) the ROI is searched around the last one
+def get_preview(img, enclosure_func, image_parameters, canvas, tracker=None, pool=None):
+    if pool is None:
+        pool = BufferPool()
+    img_gray = img_proc.grayscale(img, dst=pool.get('gray', img.shape[:2]))
 
     # Search for Region of Interest
-    roi_attr, img_bin = img_proc.get_roi_attr(img_gray, image_parameters)
-    
-    # Make a blank image for Resolution output
-    focus_img = np.zeros((100,400,3), np.uint8)
+    if tracker is not None:
+        roi_attr, img_bin = tracker.get_roi_attr(img_gray, image_parameters, pool=pool)
+    else:
+        roi_attr, img_bin = img_proc.get_roi_attr(img_gray, image_parameters, pool=pool)
+
+    img_scale = canvas.draw_panel(0, img)
+    canvas.draw_panel(1, img_bin)
+    text = []
 
     # Check if Region of Interest was found
     if roi_attr is not None:
         roi = img_proc.get_roi(img, roi_attr)
         roi_gray = img_proc.get_roi(img_gray, roi_attr)
 
-        contours, roi_bin = img_proc.get_roi_contours(roi_gray, image_parameters)
+        contours, roi_bin = img_proc.get_roi_contours(roi_gray, image_parameters, pool=pool)
         
         # find contours
         # get the right enclosing for every contour found
         enc = []
         for c in contours:
             enc.append(enclosure_func(c))
-        
-        # We need every image in Color
-        img_bin = img_proc.bgr(img_bin) 
-        roi_bin = img_proc.bgr(roi_bin)
-
-        # Draw all the Contours
-        img_proc.draw_rectangle(img, roi_attr)
-        img_proc.draw_rectangle(img_bin, roi_attr)
-        img_proc.draw_contours(roi, enc)
-        img_proc.draw_contours(roi_bin, enc)
-
-        # Resize small images for concatenating (all images must be same size)
-        roi_display = cv2.resize(roi, (img.shape[1],img.shape[0]))
-        roi_bin_display = cv2.resize(roi_bin, (img.shape[1],img.shape[0]))
-
-        # Measure the focus of the zoom image and draw it on the focus image
-        fm = int(img_proc.measure_focus(roi_gray))
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        text = "Focus: " + str(fm)
-        textsize = cv2.getTextSize(text, font, 1, 2)[0]
-        textX = 20
-        textY = int((focus_img.shape[0] + textsize[1]) / 2)
-        cv2.putText(focus_img, text, (textX, textY), font, 1, (255, 255, 255), 2)
+
+        # Draw the ROIs and all the Contours
+        roi_scale = canvas.draw_panel(2, roi)
+        canvas.draw_panel(3, roi_bin)
+        canvas.draw_rectangle(0, roi_attr, img_scale)
+        canvas.draw_rectangle(1, roi_attr, img_scale)
+        canvas.draw_contours(2, enc, roi_scale)
+        canvas.draw_contours(3, enc, roi_scale)
+
+        # Measure the focus of the zoom image
+        text.append("Focus: " + str(int(img_proc.measure_focus(roi_gray, pool=pool))))
 
     else: # No Contours were found -> display black images
-        img_bin = img_proc.bgr(img_bin) # We need every image in Color
-        roi_display = np.zeros_like(img)
-        roi_bin_display = roi_display.copy()
+        canvas.clear_panel(2)
+        canvas.clear_panel(3)
+
+    # Show how often the tracker found the ROI
+    if tracker is not None:
+        text.append("Tracking: " + str(int(tracker.hit_rate() * 100)) + "%")
+
+    canvas.write_text(0, "   ".join(text))
+    return canvas
 
 
-    return img, img_bin, roi_display, roi_bin_display, focus_img
+## Live preview in three stages: capture thread, processing thread and the display (main thread)
+# The stages are connected by single-slot queues, a stage always takes the newest
+# frame and skips the ones it was too slow for. This keeps the latency low.
+# The processing draws into one of 3 canvases: one is waiting for the display,
+# one is being displayed and one is free.
+# A frame that can't be processed gets skipped. If the capture stops or
+# MAX_FAILURES frames in a row fail, failed gets set and the preview should end.
+class PreviewPipeline:
+    MAX_FAILURES = 10
 
+    def __init__(self, cam, image_parameters, display_size, enclosure=contour, tracker=None):
+        self.cam = cam
+        self.image_parameters = image_parameters
+        self.display_size = display_size
+        self.enclosure = enclosure # can be changed while running
+        self.tracker = tracker
+        self.captured = LatestSlot() # (image, capture time)
+        self.processed = LatestSlot() # (canvas, capture time)
+        self.free = queue.Queue()
+        for _ in range(3):
+            self.free.put(PreviewCanvas(display_size))
+        self.capture_rate = RateMeter()
+        self.process_rate = RateMeter()
+        self.running = False
+        self.failed = False
 
-## Method for the trackbars to change the parameters
-def change_image_param(val, tb_name):
-    config.param['image_parameters'][tb_name] = str(val)
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self._capture, daemon=True),
+                        threading.Thread(target=self._process, daemon=True)]
+        for thread in self.threads:
+            thread.start()
 
+    def stop(self):
+        self.running = False
+        self.captured.close()
+        self.processed.close()
+        for thread in self.threads:
+            thread.join(timeout=2.0)
 
-## Create a second window with all the trackbars
-def create_param_window(win_name):
-    cv2.namedWindow(win_name)
-    #cv2.createTrackbar('blur_full', win_name, int(config.param['image_parameters']['blur_full']), 100, lambda x: change_image_param(x, 'blur_full'))
-    #cv2.createTrackbar('block_full', win_name, int(config.param['image_parameters']['thresh_block_full']), 100, lambda x: change_image_param(x, 'thresh_block_full'))
-    #cv2.createTrackbar('const_full', win_name, int(config.param['image_parameters']['thresh_const_full']), 100, lambda x: change_image_param(x, 'thresh_const_full'))
-    #cv2.createTrackbar('blur_roi', win_name, int(config.param['image_parameters']['blur_roi']), 100, lambda x: change_image_param(x, 'blur_roi'))
-    #cv2.createTrackbar('block_roi', win_name, int(config.param['image_parameters']['thresh_block_roi']), 100, lambda x: change_image_param(x, 'thresh_block_roi'))
-    #cv2.createTrackbar('const_roi', win_name, int(config.param['image_parameters']['thresh_const_roi']), 100, lambda x: change_image_param(x, 'thresh_const_roi'))
+    def _capture(self):
+        try:
+            for frame in self.cam.capture_continous():
+                if not self.running:
+                    return
+                self.captured.put((frame.array, time.monotonic()))
+                self.capture_rate.tick()
+                self.cam.truncate_output()
+        except Exception:
+            traceback.print_exc()
+        if self.running:
+            print("Capture stopped.")
+            self.failed = True
+
+    def _process(self):
+        pool = BufferPool() # working arrays of the processing thread
+        failures = 0
+        while self.running and not self.failed:
+            item = self.captured.get(timeout=0.1)
+            if item is None:
+                continue
+            image, capture_time = item
+            canvas = self.free.get()
+            try:
+                get_preview(image, self.enclosure, self.image_parameters, canvas, tracker=self.tracker, pool=pool)
+            except Exception:
+                self.free.put(canvas)
+                failures += 1
+                if failures == 1:
+                    traceback.print_exc()
+                if failures >= self.MAX_FAILURES:
+                    print("Processing failed " + str(failures) + " times in a row.")
+                    self.failed = True
+                continue
+            failures = 0
+            self.process_rate.tick()
+            dropped = self.processed.put((canvas, capture_time))
+            if dropped is not None:
+                self.free.put(dropped[0])
+
+    # Newest processed canvas with the rates and the latency written on it, None if there was none
+    # Give it back with release() after it was shown
+    def get_display(self, timeout=0.1):
+        item = self.processed.get(timeout)
+        if item is None:
+            return None
+        canvas, capture_time = item
+        latency = (time.monotonic() - capture_time) * 1000
+        canvas.write_text(1, "Capture: %.1f FPS   Processing: %.1f FPS   Latency: %d ms" % (
+            self.capture_rate.rate(), self.process_rate.rate(), latency))
+        return canvas
+
+    def release(self, canvas):
+        self.free.put(canvas)
 
 
 ## Start live preview
@@ -92,29 +222,24 @@ if __name__ == "__main__":
     print("Starting Preview")
 
     config = ConfigReader()
-    cam = Camera(config.param['camera_parameters'], preview=True)
+    cam = create_camera(config.param['camera_parameters'], preview=True)
     cam.open()
     
     enclosure = contour # default enclosure
-    create_param_window('Parameters')
+    tracker = RoiTracker()
         
-    for frame in cam.capture_continous():
-        image = frame.array
-        # Get the 4 Images for the preview and the focus image
-        img, img_bin, roi, roi_bin, focus_img = get_preview(image, enclosure, config.param['image_parameters'])
-
-        # concat the 4 images to one big one
-        result0 = cv2.hconcat([img, img_bin]) 
-        result1 = cv2.hconcat([roi, roi_bin])
-        result = cv2.vconcat([result0, result1])
-        result = cv2.resize(result, (int(config.param['display_parameters']['preview_width']),
-                                    int(config.param['display_parameters']['preview_height'])))
-
-        # display in separate window
-        cv2.imshow("Preview", result)
-        cv2.imshow('Parameters', focus_img)
+    pipeline = PreviewPipeline(cam, config.param['image_parameters'],
+                               (int(config.param['display_parameters']['preview_width']),
+                                int(config.param['display_parameters']['preview_height'])),
+                               enclosure=enclosure, tracker=tracker)
+    pipeline.start()
+
+    while not pipeline.failed:
+        canvas = pipeline.get_display()
+        if canvas is not None:
+            cv2.imshow("Preview", canvas.image)
+            pipeline.release(canvas)
         key = cv2.waitKey(1) & 0xFF
-        cam.truncate_output()
 
         # Break if 'q' key is pressed
         if key == ord('q'):
@@ -128,9 +253,12 @@ if __name__ == "__main__":
         # enclosure method
         elif chr(key) in enclosure_parser:
             print(enclosure_parser[chr(key)].__name__)
-            enclosure = enclosure_parser[chr(key)]
-
+            pipeline.enclosure = enclosure_parser[chr(key)]
 
+    pipeline.stop()
+    print("Dropped frames: " + str(pipeline.captured.dropped) + " before processing, " +
+          str(pipeline.processed.dropped) + " before display")
+    print("ROI tracking hit rate: " + str(int(tracker.hit_rate() * 100)) + "% of " + str(tracker.frames) + " frames")
     print("Terminating Program!")
     cam.close()
     cv2.destroyAllWindows() # close all windows
\ No newline at end of file
@@ -1,92 +1,222 @@
-import serial
-import struct
+import asyncio
+import traceback
 from time import sleep
-from gpiozero import LED
-from image_info import get_image_info
-from lib.config_reader import ConfigReader
-from lib.cam import Camera
-from time import time
-
-# Read the config file
-config = ConfigReader()
-print("Starting Camera")
-
-# Define Hardware Pins
-flash = LED(int(config.param['hardware_parameters']['flash_pin']))
-
-# Open camera
-sleep(5)
-cam = Camera(config.param['camera_parameters'])
-cam.open()
-
-# Open serial port
-ser = serial.Serial()
-ser.port = config.param['serial_parameters']['port']
-ser.baudrate = int(config.param['serial_parameters']['baudrate'])
-ser.open()
-ser.reset_input_buffer()
-ser.reset_output_buffer()
-print("Serial openend")
-
-def send_int_list(int_list):
-    print(int_list)
-    for i in int_list:
-        if i == 10: i += 1 #No byte can be 10 or it would be confused with LineFeed
-        if i > 255: i == 255 #Byte can't be bigger than 255
-        b = struct.pack('B', i)
-        ser.write(b)
-    ser.write(b'\n')
-
-# Endless loop listening for messages
-while True:
-    print("Waiting for message...")
-    recv_data = b''
-
-    # Read the bytes until a Return is hit
-    while True:
-        recv_byte = ser.read()
-        if recv_byte == b'\r':
-            break
-        recv_data += recv_byte
-    print("Message recieved!") 
-
-    # Decode the bytes to string with UTF-8
-    data_str = recv_data.decode()
-    print("Message: " + data_str)
-    
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+from lib.protocol import encode_ints, encode_text, encode_packed, parse_command, LEGACY, FRAMED
+
+
+## Serial command server
+# Reads the commands of the PLC (ending with '\r') in an asyncio loop.
+# The image processing runs on an executor, so commands like 'ping' or 'flash'
+# get answered while an image is processed. With request IDs ('7:shoot') the
+# PLC can queue the next 'shoot' while the last result is still computed.
+class SerialServer:
+    def __init__(self, ser, process_image, protocol=LEGACY, packed_bits=6, flash=None):
+        self.ser = ser
+        self.process_image = process_image # function(save_imgs) -> info_list, blocking
+        self.protocol = protocol
+        self.default_protocol = protocol
+        self.packed_bits = packed_bits
+        self.packed = False # the PLC can request packed answers with 'packed' and go back with 'unpacked'
+        self.flash = flash
+        self.buffer = b''
+        # One worker, the camera and the processing can only do one image at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.tasks = set()
+
+        # Command registry: name -> handler(request_id)
+        self.commands = {
+            'ping'   : self.cmd_ping,
+            'shoot'  : self.cmd_shoot,
+            'save'   : self.cmd_save,
+            'packed' : self.cmd_packed,
+            'unpacked' : self.cmd_unpacked,
+            'flash'  : self.cmd_flash,
+            'exit'   : self.cmd_exit,
+        }
+
+    def register(self, name, handler):
+        self.commands[name] = handler
+
+    ## Sending
+    # Every answer gets written at once
+    def send_int_list(self, int_list, request_id=None):
+        print(int_list)
+        if self.packed:
+            self.ser.write(encode_packed(int_list, self.packed_bits, request_id))
+        else:
+            self.ser.write(encode_ints(int_list, self.protocol, request_id))
+
+    def send_text(self, text, request_id=None):
+        self.ser.write(encode_text(text, self.protocol, request_id))
+
+    ## Commands
     # Send 'pong' if someone pings
-    if data_str == 'ping':
-        ser.write("pong".encode())
-        ser.write(b'\n')
+    async def cmd_ping(self, request_id):
+        self.send_text("pong", request_id)
 
     # Take image, process it and send the info string
-    elif data_str == 'shoot':
-        image = cam.capture_image()
-        info_list = get_image_info(image, config.param['image_parameters'], save_imgs=False)
-        send_int_list(info_list)
+    async def cmd_shoot(self, request_id):
+        await self.run_processing(False, request_id)
 
-    # Take image, process it and send the info string
-    elif data_str == 'save':
-        image = cam.capture_image()
-        info_list = get_image_info(image, config.param['image_parameters'], save_imgs=True)
-        send_int_list(info_list)
+    # Take image, process it, save the debug images and send the info string
+    async def cmd_save(self, request_id):
+        await self.run_processing(True, request_id)
+
+    async def run_processing(self, save_imgs, request_id):
+        loop = asyncio.get_running_loop()
+        try:
+            info_list = await loop.run_in_executor(self.executor, self.process_image, save_imgs)
+        except Exception:
+            traceback.print_exc()
+            self.send_text("error", request_id)
+            return
+        self.send_int_list(info_list, request_id)
+
+    # Switch to the compact bit-packed answers, they are always framed
+    async def cmd_packed(self, request_id):
+        self.send_text("ok", request_id)
+        self.packed = True
+        self.protocol = FRAMED
+
+    # Back to the answers of the configured protocol, the 'ok' still comes framed
+    async def cmd_unpacked(self, request_id):
+        self.send_text("ok", request_id)
+        self.packed = False
+        self.protocol = self.default_protocol
 
     # Turn Flash on and off
-    elif data_str == 'flash':
-        if flash.is_active:
-            flash.off()
+    async def cmd_flash(self, request_id):
+        if self.flash is None:
+            return
+        if self.flash.is_active:
+            self.flash.off()
         else:
-            flash.on()
+            self.flash.on()
+
+    # Stop the server
+    async def cmd_exit(self, request_id):
+        if not self.stopped.done(): # a second 'exit' can come before the shutdown
+            self.stopped.set_result(None)
+
+    ## Receiving
+    async def handle_command(self, data_str):
+        print("Message: " + data_str)
+        request_id, cmd = parse_command(data_str)
+        handler = self.commands.get(cmd)
+        if handler is None: # Send N/A if command is not known
+            self.send_text("n/a", request_id)
+        else:
+            await handler(request_id)
+
+    # Called by the loop when bytes are waiting
+    def on_readable(self):
+        self.buffer += self.ser.read(max(self.ser.in_waiting, 1))
+        # Every command ends with a Return
+        while b'\r' in self.buffer:
+            recv_data, self.buffer = self.buffer.split(b'\r', 1)
+            data_str = recv_data.decode(errors='replace').strip()
+            task = asyncio.ensure_future(self.handle_command(data_str))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    # Serve until the 'exit' command
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        loop.add_reader(self.ser.fileno(), self.on_readable)
+        print("Waiting for messages...")
+        try:
+            await self.stopped
+            # Answer all commands still in progress
+            if self.tasks:
+                await asyncio.gather(*self.tasks)
+        finally:
+            loop.remove_reader(self.ser.fileno())
+
+    def run(self):
+        asyncio.run(self.serve())
+        self.executor.shutdown()
+
+
+## Main method
+if __name__ == "__main__":
+    from gpiozero import LED
+    from image_info import get_image_info
+    from lib.config_reader import ConfigReader
+    from lib.cam import create_camera
+    from lib.image_writer import ImageWriter
+    from lib.capture_log import CaptureLog
+
+    # Read the config file
+    config = ConfigReader()
+    print("Starting Camera")
+
+    # Define Hardware Pins
+    flash = LED(int(config.param['hardware_parameters']['flash_pin']))
+
+    # Open camera
+    sleep(5)
+    cam = create_camera(config.param['camera_parameters'])
+    cam.open()
+
+    # Grab the frames in the background, so 'shoot' doesn't have to wait for a capture
+    grab_frames = config.param['camera_parameters'].get('capture_mode', 'still') == 'grab'
+    if grab_frames:
+        cam.start_grabbing()
+
+    # Debug images of the 'save' command get written in the background
+    writer = ImageWriter()
+    debug_config = config.param['debug_parameters'] if config.param.has_section('debug_parameters') else {}
+    max_saves = int(debug_config.get('max_saves', '10'))
+    max_bytes = int(debug_config.get('max_megabytes', '0')) * 1024 * 1024 or None
+
+    # Or all debug images of this session go into a capture log, split into segments
+    capture_log = None
+    if debug_config.get('save_format', 'folders') == 'log':
+        segment_bytes = int(debug_config.get('log_segment_megabytes', '20')) * 1024 * 1024 or None
+        capture_log = CaptureLog('./raspi/debug/', debug_config.get('log_compression', 'zlib'),
+                                 segment_bytes=segment_bytes, max_bytes=max_bytes)
+        print("Capture log: " + capture_log.path)
+
+    # Freshest grabbed frame, or a still capture if grabbing is off or failed
+    def get_image():
+        if grab_frames:
+            image, _ = cam.get_frame()
+            if image is not None:
+                return image
+        return cam.capture_image()
+
+    # Take an image and process it (runs on the executor of the server)
+    # Changes of config.ini get picked up without a restart
+    def process_image(save_imgs):
+        config.reload_if_changed()
+        image = get_image()
+        return get_image_info(image, config.image_parameters, save_imgs=save_imgs,
+                              writer=writer if save_imgs else None,
+                              max_saves=max_saves, max_bytes=max_bytes, capture_log=capture_log)
 
-    # Break the loop and terminate the program
-    elif data_str == 'exit':
-        break
+    # Open serial port
+    ser = serial.Serial()
+    ser.port = config.param['serial_parameters']['port']
+    ser.baudrate = int(config.param['serial_parameters']['baudrate'])
+    ser.open()
+    ser.reset_input_buffer()
+    ser.reset_output_buffer()
+    print("Serial openend")
 
-    # Send N/A if command is not known
-    else:
-        ser.write("n/a".encode())
-        ser.write(b'\n')
+    server = SerialServer(ser, process_image,
+                          protocol=config.param['serial_parameters'].get('protocol', LEGACY),
+                          packed_bits=int(config.param['serial_parameters'].get('packed_bits', '6')),
+                          flash=flash)
+    server.run()
 
-# Close the open interfaces
-cam.close()
-ser.close()
\ No newline at end of file
+    # Close the open interfaces and write the remaining debug images
+    writer.close()
+    if capture_log is not None:
+        capture_log.close()
+    cam.close()
+    ser.close()
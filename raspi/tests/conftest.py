@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts of raspi/ import the project modules as lib.x, like serial_com.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,54 @@
+from lib.packing import pack_info_list, unpack_info_list, quantize, dequantize, zigzag, unzigzag
+
+
+# Info list like get_image_info() returns: roi_x, roi_y, roi_area, focus, count, then type, x, y per shape
+def make_info_list(shapes):
+    info_list = [120, 80, 60, 42, len(shapes)]
+    for shape in shapes:
+        info_list += shape
+    return info_list
+
+
+def test_round_trip_8_bits():
+    shapes = [[0, 10, 20], [1, 200, 20], [2, 15, 100], [3, 255, 255]]
+    info_list = make_info_list(shapes)
+    unpacked = unpack_info_list(pack_info_list(info_list, bits=8))
+    assert unpacked[:5] == info_list[:5]
+    # shapes come back in reading order
+    expected = sorted(shapes, key=lambda s: (s[2], s[1]))
+    assert [unpacked[i:i+3] for i in range(5, len(unpacked), 3)] == expected
+
+def test_round_trip_quantized():
+    info_list = make_info_list([[0, 10, 20], [1, 130, 20], [2, 250, 240]])
+    for bits in range(1, 9):
+        unpacked = unpack_info_list(pack_info_list(info_list, bits))
+        for i in range(5, len(info_list), 3):
+            for value, got in zip(info_list[i+1:i+3], unpacked[i+1:i+3]):
+                assert got == dequantize(quantize(value, bits), bits)
+                assert abs(got - value) <= 1 << (8 - bits)
+
+## Values out of the byte range get clamped, like in the unpacked answers
+# (999 is the value of an unknown ROI)
+def test_clamp_999():
+    info_list = [999, 999, 999, 999, 1, 0, 999, 999]
+    unpacked = unpack_info_list(pack_info_list(info_list, bits=8))
+    assert unpacked == [255, 255, 255, 255, 1, 0, 255, 255]
+
+def test_coordinates_above_255():
+    info_list = make_info_list([[1, 300, 20], [2, 20, 256], [3, 1000, 1000]])
+    unpacked = unpack_info_list(pack_info_list(info_list, bits=6))
+    assert unpacked[5:] == [1, dequantize(63, 6), dequantize(5, 6),
+                            2, dequantize(5, 6), dequantize(63, 6),
+                            3, dequantize(63, 6), dequantize(63, 6)]
+
+def test_negative_values():
+    unpacked = unpack_info_list(pack_info_list([-5, 10, 20, -1, 1, 0, -3, 5], bits=8))
+    assert unpacked == [0, 10, 20, 0, 1, 0, 0, 5]
+
+def test_without_shapes():
+    assert unpack_info_list(pack_info_list([999, 10, 20])) == [255, 10, 20]
+
+
+def test_zigzag():
+    for value in range(-300, 300):
+        assert unzigzag(zigzag(value)) == value
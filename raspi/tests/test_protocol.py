@@ -0,0 +1,64 @@
+from lib.protocol import (crc16, escape, unescape, encode_frame, encode_ints, encode_text,
+                          FrameDecoder, frame_to_answer, split_request_id, parse_command,
+                          FLAG, ESC, TYPE_INTS, TYPE_TEXT, FRAMED)
+
+
+## CRC-16/CCITT-FALSE check value
+def test_crc16_check_value():
+    assert crc16(b'123456789') == 0x29B1
+
+
+def test_escape_round_trip():
+    data = bytes([FLAG, ESC, 0x00, FLAG, FLAG, 0x5E, 0x5D, ESC, 0xFF])
+    escaped = escape(data)
+    assert FLAG not in escaped
+    assert unescape(escaped) == data
+
+def test_escape_all_bytes():
+    data = bytes(range(256))
+    assert unescape(escape(data)) == data
+
+
+def test_decoder_reads_frames():
+    decoder = FrameDecoder()
+    frames = decoder.feed(encode_ints([1, FLAG, ESC, 255], FRAMED) + encode_text("pong", FRAMED))
+    assert [frame_to_answer(*f) for f in frames] == [[1, FLAG, ESC, 255], "pong"]
+    assert decoder.errors == 0
+
+# The frame arrives in single bytes
+def test_decoder_split_input():
+    decoder = FrameDecoder()
+    frames = []
+    for b in encode_text("pong", FRAMED):
+        frames += decoder.feed(bytes([b]))
+    assert frames == [(TYPE_TEXT, b"pong")]
+
+## A frame with a broken CRC gets dropped, the next frame is read again
+def test_decoder_drops_corrupted_frame():
+    broken = bytearray(encode_frame(TYPE_INTS, bytes([10, 20, 30])))
+    broken[5] ^= 0x01 # first payload byte, after FLAG, VERSION, TYPE and LENGTH
+    decoder = FrameDecoder()
+    frames = decoder.feed(bytes(broken) + encode_frame(TYPE_INTS, bytes([40, 50])))
+    assert frames == [(TYPE_INTS, bytes([40, 50]))]
+    assert decoder.errors == 1
+
+# Noise before the first flag is ignored
+def test_decoder_resyncs_after_noise():
+    decoder = FrameDecoder()
+    frames = decoder.feed(b'\x01\x02garbage' + encode_text("ok", FRAMED))
+    assert frames == [(TYPE_TEXT, b"ok")]
+
+
+def test_request_id_round_trip():
+    frames = FrameDecoder().feed(encode_ints([3, 4], FRAMED, request_id=7))
+    assert split_request_id(*frames[0]) == (7, TYPE_INTS, bytes([3, 4]))
+    assert frame_to_answer(*frames[0]) == [3, 4]
+
+def test_legacy_request_id():
+    assert encode_ints([3, 4], request_id=7) == bytes([7, 3, 4]) + b'\n'
+    assert encode_text("pong", request_id=7) == b'7:pong\n'
+
+def test_parse_command():
+    assert parse_command('7:shoot') == (7, 'shoot')
+    assert parse_command('shoot') == (None, 'shoot')
+    assert parse_command('300:shoot') == (None, '300:shoot')
@@ -0,0 +1,126 @@
+import os
+import pty
+import select
+import threading
+
+import pytest
+import serial
+
+from lib.protocol import FrameDecoder, frame_to_answer, split_request_id, LEGACY, FRAMED
+from lib.packing import pack_info_list, unpack_info_list
+from serial_com import SerialServer
+
+INFO_LIST = [120, 80, 60, 42, 2, 0, 20, 30, 1, 200, 40] # no 10, that's the '\n' of the legacy answers
+
+
+## SerialServer on one end of a pseudo terminal, the test is the PLC on the other end
+class ServerFixture:
+    def __init__(self, protocol):
+        self.master, slave = pty.openpty()
+        self.ser = serial.Serial(os.ttyname(slave), timeout=0)
+        os.close(slave)
+        self.shots = []
+        self.release = threading.Event() # 'shoot' blocks until it's set
+        self.server = SerialServer(self.ser, self.process_image, protocol=protocol)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def process_image(self, save_imgs):
+        self.shots.append(save_imgs)
+        if not self.release.wait(5):
+            raise RuntimeError("shoot was not released")
+        return INFO_LIST
+
+    def run(self):
+        try:
+            self.server.run()
+        except Exception as e:
+            self.error = e
+
+    def send(self, cmds):
+        os.write(self.master, b''.join(cmd.encode() + b'\r' for cmd in cmds))
+
+    def read(self, timeout=5):
+        if not select.select([self.master], [], [], timeout)[0]:
+            raise TimeoutError("no answer")
+        return os.read(self.master, 1024)
+
+    # Legacy answers up to the '\n'
+    def read_lines(self, count):
+        data = b''
+        while data.count(b'\n') < count:
+            data += self.read()
+        return data.split(b'\n')[:count]
+
+    # (request_id, answer) of the next frames
+    def read_frames(self, count):
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < count:
+            frames += decoder.feed(self.read())
+        return [(split_request_id(*f)[0], frame_to_answer(*f)) for f in frames]
+
+    def stop(self):
+        self.release.set()
+        self.send(['exit'])
+        self.thread.join(5)
+        self.ser.close()
+        os.close(self.master)
+        assert not self.thread.is_alive()
+        assert self.error is None
+
+
+@pytest.fixture
+def legacy_server():
+    server = ServerFixture(LEGACY)
+    yield server
+    server.stop()
+
+@pytest.fixture
+def framed_server():
+    server = ServerFixture(FRAMED)
+    yield server
+    server.stop()
+
+
+## 'ping' gets answered while 'shoot' is still processed, both with their request ID
+def test_ping_during_shoot(legacy_server):
+    legacy_server.send(['1:shoot', '2:ping'])
+    assert legacy_server.read_lines(1) == [b'2:pong']
+    assert legacy_server.shots == [False]
+    legacy_server.release.set()
+    assert legacy_server.read_lines(1) == [bytes([1] + INFO_LIST)]
+
+def test_unknown_command(legacy_server):
+    legacy_server.send(['blub', '5:blub'])
+    assert legacy_server.read_lines(2) == [b'n/a', b'5:n/a']
+
+def test_framed_request_ids(framed_server):
+    framed_server.release.set()
+    framed_server.send(['7:save', '8:ping', 'ping'])
+    answers = framed_server.read_frames(3)
+    assert sorted(answers, key=str) == sorted([(7, INFO_LIST), (8, 'pong'), (None, 'pong')], key=str)
+    assert framed_server.shots == [True]
+
+## After 'packed' the answers come in packed frames, 'unpacked' goes back to legacy
+# The 'ok' comes in the protocol that was used for the command
+def test_packed_unpacked(legacy_server):
+    legacy_server.release.set()
+    legacy_server.send(['packed'])
+    assert legacy_server.read_lines(1) == [b'ok']
+    legacy_server.send(['3:shoot'])
+    (request_id, answer), = legacy_server.read_frames(1)
+    assert request_id == 3
+    assert answer == unpack_info_list(pack_info_list(INFO_LIST, legacy_server.server.packed_bits))
+    legacy_server.send(['unpacked'])
+    assert legacy_server.read_frames(1) == [(None, 'ok')]
+    legacy_server.send(['ping'])
+    assert legacy_server.read_lines(1) == [b'pong']
+
+## A second 'exit' before the shutdown doesn't crash the server
+def test_double_exit(legacy_server):
+    legacy_server.send(['exit', 'exit'])
+    legacy_server.thread.join(5)
+    assert not legacy_server.thread.is_alive()
+    assert legacy_server.error is None